@@ -1,12 +1,17 @@
 import unittest
 import torch as tc
 from torch import nn
-from torchpm import covariate, odesolver, predfunction, models, loss
+from torchpm import covariate, odesolver, predfunction, models, loss, design, misc
 from torchpm import data
 from torchpm.data import CSVDataset
 from torchpm.parameter import *
 import matplotlib.pyplot as plt
 import numpy as np
+import sympy as sym
+import json
+import os
+import tempfile
+import torch.distributed as dist
 
 if __name__ == '__main__' :
     unittest.main()
@@ -127,6 +132,139 @@ class FisherInformationMatrixTest(unittest.TestCase):
                 ax.plot(time_data, y_pred.detach().to('cpu'), marker='.', linestyle='', color='gray')
         plt.show()
 
+    def test_fisher_information_matrix_batch(self):
+        dataset_np = np.loadtxt('./examples/THEO.csv', delimiter=',', dtype=np.float32, skiprows=1)
+        column_names = ['ID', 'AMT', 'TIME', 'DV', 'CMT', "MDV", "RATE", 'BWT']
+        dataset = CSVDataset(dataset_np, column_names)
+        dataset_padded = CSVDataset(dataset_np, column_names, padded=True)
+
+        model = models.FOCEInter(dataset = dataset,
+                                output_column_names= ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = BasementModel, 
+                                theta_names=['theta_0', 'theta_1', 'theta_2'],
+                                eta_names= ['eta_0', 'eta_1','eta_2'], 
+                                eps_names= ['eps_0','eps_1'], 
+                                omega=Omega([0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205], False), 
+                                sigma=Sigma([[0.0177], [0.0762]], [True, True]),
+                                optimal_design_creterion=loss.DOptimality())
+
+        optimizer = tc.optim.LBFGS(model.parameters())
+        loss_batch = model.optimization_function_closure_FIM(dataset_padded, optimizer)()
+        loss_value = model.optimization_function_closure_FIM(dataset, optimizer)()
+        self.assertTrue(tc.allclose(loss_batch, loss_value, rtol=1e-4))
+
+        # forward-mode 미분으로 구한 행렬이 관측값마다 backward한 jacobian으로 구한 행렬과 같아야 한다
+        theta_dict = model.pred_function.get_theta_parameter_values()
+        thetas = [theta_dict[key] for key in model.theta_names]
+        y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = model.forward_batch(dataset_padded.padded_dataset, partial_differentiate_by_etas = False, partial_differentiate_by_epss = True)
+        gr_theta = tc.stack(misc.jacobian(y_pred[0][mdv_mask[0]], thetas), dim=-1)
+        expected = misc.fisher_information_matrix_by_linearization(gr_theta, h[0][mdv_mask[0]], omega, sigma)
+        fisher_information_matrices = model.fisher_information_matrix_batch(dataset_padded.padded_dataset)
+        self.assertTrue(tc.allclose(fisher_information_matrices[0], expected, rtol=1e-4))
+
+    def test_fedorov_exchange(self):
+        dataset_np = np.loadtxt('./examples/THEO.csv', delimiter=',', dtype=np.float32, skiprows=1)
+        column_names = ['ID', 'AMT', 'TIME', 'DV', 'CMT', "MDV", "RATE", 'BWT']
+        dataset = CSVDataset(dataset_np, column_names)
+
+        model = models.FOCEInter(dataset = dataset,
+                                output_column_names= ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = AmtModel, 
+                                theta_names=['theta_0'],
+                                eta_names= ['eta_0'], 
+                                eps_names= ['eps_0','eps_1'], 
+                                omega=Omega([0.4397], True), 
+                                sigma=Sigma([[0.0177], [0.0762]], [True, True]),
+                                optimal_design_creterion=loss.DOptimality())
+
+        template, _ = dataset[0]
+        schedules = design.candidate_schedules(tc.tensor([0.25, 0.5, 1., 2., 4., 8., 12., 24.]), 3)
+        search = design.FedorovExchange(model, template, schedules)
+        self.assertEqual(search.fisher_information_matrices.size()[0], schedules.size()[0])
+
+        greedy_result = search.greedy(4)
+        exchange_result = search.exchange(4)
+        self.assertEqual(exchange_result['schedules'].size(), (4, 3))
+        self.assertLessEqual(float(exchange_result['loss']), float(greedy_result['loss']) + 1e-5)
+
+        fisher_information_matrix = exchange_result['fisher_information_matrix'] + tc.eye(3) * search.jitter
+        self.assertTrue(tc.allclose(exchange_result['loss'], loss.DOptimality()(fisher_information_matrix), rtol=1e-4))
+
+        # 매 교환마다 다시 계산해도 같은 설계를 찾는다
+        refreshed_result = search.exchange(4, refresh_interval = 1)
+        self.assertTrue(tc.equal(refreshed_result['indice'], exchange_result['indice']))
+
+        # 교환이 받아들여질 때만 다시 계산하므로, 연속한 두 계산 사이에는 항상 교환이 있다
+        refreshed_indice = []
+        fisher_information_matrix_function = search._fisher_information_matrix
+        search._fisher_information_matrix = lambda indice : refreshed_indice.append(list(indice)) or fisher_information_matrix_function(indice)
+        search.exchange(4, indice = [0, 0, 0, 0], refresh_interval = 1)
+        self.assertGreater(len(refreshed_indice), 1)
+        for previous, current in zip(refreshed_indice, refreshed_indice[1:]) :
+            self.assertNotEqual(previous, current)
+
+        refreshed_indice.clear()
+        search.exchange(4, indice = [0, 0, 0, 0], refresh_interval = 1000)
+        self.assertEqual(len(refreshed_indice), 1)
+        del search._fisher_information_matrix
+
+        # 추가 인자가 필요한 기준은 criterion_arguments로 인자를 만든다
+        model.design_optimal_function = loss.DSOptimality()
+        search_ds = design.FedorovExchange(model, template, schedules, criterion_arguments = lambda m : (m[..., 1:, 1:],))
+        ds_result = search_ds.exchange(4)
+        fisher_information_matrix = ds_result['fisher_information_matrix'] + tc.eye(3) * search_ds.jitter
+        self.assertTrue(tc.allclose(ds_result['loss'], loss.DSOptimality()(fisher_information_matrix, fisher_information_matrix[1:, 1:]), rtol=1e-4))
+
+    def test_make_design_dataset(self):
+        column_names = ['ID', 'AMT', 'TIME', 'DV', 'CMT', "MDV", "RATE", 'BWT']
+        template = tc.tensor([[1., 320., 0., 0., 1., 1., 0., 70.],
+                              [1., 0., 1., 5., 1., 0., 0., 70.],
+                              [1., 320., 12., 0., 1., 1., 0., 70.]])
+        schedules = tc.tensor([[0., 12., 24.], [1., 2., 12.]])
+        records = design.make_design_dataset(template, column_names, schedules, -1)
+
+        # 같은 시간이면 투약 기록이 관측 기록보다 앞선다
+        self.assertTrue(tc.equal(records[0, :, 2], tc.tensor([0., 0., 12., 12., 24.])))
+        self.assertTrue(tc.equal(records[0, :, 5], tc.tensor([1., 0., 1., 0., 0.])))
+        self.assertTrue(tc.equal(records[1, :, 2], tc.tensor([0., 1., 2., 12., 12.])))
+        self.assertTrue(tc.equal(records[1, :, 5], tc.tensor([1., 0., 0., 1., 0.])))
+        self.assertTrue((records[:, :, 0] == -1).all())
+
+
+class DesignOptimalityTest(unittest.TestCase):
+    def test_batched_criteria(self):
+        tc.manual_seed(0)
+        fisher_information_matrices = tc.stack([misc.make_positive_definite_matrix(4) * 1e3 for _ in range(5)])
+        fisher_information_matrices_ns = fisher_information_matrices[:, 1:, 1:]
+
+        d_batch = loss.DOptimality()(fisher_information_matrices)
+        a_batch = loss.AOptimality()(fisher_information_matrices)
+        ds_batch = loss.DSOptimality()(fisher_information_matrices, fisher_information_matrices_ns)
+        for i, m in enumerate(fisher_information_matrices) :
+            self.assertTrue(tc.allclose(d_batch[i], loss.DOptimality()(m)))
+            self.assertTrue(tc.allclose(d_batch[i], -m.det().log(), rtol=1e-4))
+            self.assertTrue(tc.allclose(a_batch[i], m.inverse().trace().log(), rtol=1e-4))
+            self.assertTrue(tc.allclose(ds_batch[i], (m.det() / fisher_information_matrices_ns[i].det()).log(), rtol=1e-4))
+
+        # det 비율은 overflow 되어도 log 공간의 비율은 유한하다
+        large = tc.eye(200) * 1e4
+        self.assertTrue(tc.isfinite(loss.DSOptimality()(large, large[1:, 1:])))
+        self.assertTrue(tc.isfinite(loss.DEffectivenessOptimality()(large, large * 2, 200)))
+
+    def test_singular_matrix(self):
+        # 반올림으로 positive definite가 아닌 행렬도 jitter를 더해 기준값과 미분이 유한하다
+        gr = tc.tensor([[1., 2., 3.], [2., 4., 6.0001]], requires_grad=True)
+        fisher_information_matrices = tc.stack([gr.t() @ gr, misc.make_positive_definite_matrix(3)])
+        for criterion in [loss.DOptimality(), loss.AOptimality()] :
+            values = criterion(fisher_information_matrices)
+            self.assertTrue(tc.isfinite(values).all())
+            self.assertTrue(tc.allclose(values[1], criterion(fisher_information_matrices[1])))
+            gr_values, = tc.autograd.grad(values.sum(), gr)
+            self.assertTrue(tc.isfinite(gr_values).all())
+
+        l = misc.jittered_cholesky(fisher_information_matrices)
+        self.assertTrue(tc.allclose(l[1], tc.linalg.cholesky(fisher_information_matrices[1])))
+
 """
     Args:.
     Attributes: .
@@ -172,8 +310,114 @@ class LinearODETest(unittest.TestCase) :
         ax.plot(t.to('cpu'), result[0].detach().to('cpu').numpy())
         plt.show()
 
+    def test_cache(self):
+        t = tc.arange(0., 24., step=0.1)
+        variables = {'k_00': tc.tensor(1.), 'd': tc.tensor(320.), 'r': tc.tensor(160.)}
+        with tempfile.TemporaryDirectory() as cache_directory :
+            solved = odesolver.CompartmentModelGenerator([[True]], is_infusion=True, cache_directory=cache_directory)
+            self.assertEqual(len(os.listdir(cache_directory)), 1)
+            cached = odesolver.CompartmentModelGenerator([[True]], is_infusion=True, cache_directory=cache_directory)
+            self.assertTrue(tc.allclose(solved(t=t, **variables), cached(t=t, **variables)))
+
+    def test_cache_format(self):
+        with tempfile.TemporaryDirectory() as cache_directory :
+            odesolver.CompartmentModelGenerator([[True]], cache_directory=cache_directory)
+            file_path = os.path.join(cache_directory, os.listdir(cache_directory)[0])
+            with open(file_path) as file :
+                expressions = json.load(file)
+
+            # 다른 형식으로 저장된 파일은 읽지 않고 다시 푼다
+            with open(file_path, 'w') as file :
+                json.dump(dict(expressions, format = -1, comps = ['Symbol(1)']), file)
+            odesolver.CompartmentModelGenerator([[True]], cache_directory=cache_directory)
+
+            # sympy class가 아닌 이름은 실행하지 않는다
+            with open(file_path, 'w') as file :
+                json.dump(dict(expressions, comps = ["().__class__.__base__"]), file)
+            with self.assertRaises(ValueError) :
+                odesolver.CompartmentModelGenerator([[True]], cache_directory=cache_directory)
+            with open(file_path, 'w') as file :
+                json.dump(dict(expressions, comps = ["open('" + file_path + "')"]), file)
+            with self.assertRaises(NameError) :
+                odesolver.CompartmentModelGenerator([[True]], cache_directory=cache_directory)
+
+    def test_codegen(self):
+        # 공통 부분식을 묶으면 연산 순서가 바뀌므로 float32의 반올림 오차가 남지 않게 float64로 비교한다
+        t = tc.arange(0., 24., step=0.1, dtype=tc.float64)
+        variables = {name: tc.tensor(value, dtype=tc.float64) for name, value in {'k_00': 1.5, 'k_12': 0.6, 'k_23': 0.7, 'k_30': 0.2, 'd': 320.}.items()}
+        model = odesolver.CompartmentModelGenerator([[True]], has_depot=True, transit = 2, is_infusion=False)
+        with tempfile.TemporaryDirectory() as cache_directory :
+            generated = odesolver.CompartmentModelGenerator([[True]], has_depot=True, transit = 2, is_infusion=False, cache_directory=cache_directory, codegen=True)
+            self.assertTrue(tc.allclose(model(t=t, **variables), generated(t=t, **variables), rtol=1e-6, atol=1e-6))
+
+            # torch로 바꾸지 않는 함수도 상위 printer의 이름으로 출력된다
+            printer = odesolver.TorchCodePrinter()
+            x = sym.Symbol('x')
+            self.assertEqual(printer.doprint(sym.exp(x)), 'torch.exp(x)')
+            self.assertEqual(printer.doprint(sym.Abs(x)), 'abs(x)')
+            self.assertTrue(printer.doprint(sym.Max(x, 1)).startswith('max('))
+
+            scripted = tc.jit.script(generated.model.function)
+            arguments = {name: variables[name] if name != 't' else t for name in generated.model.argument_names}
+            self.assertTrue(tc.allclose(scripted(**arguments), generated.model(t=t, **variables)))
+
+    def test_numeric_model(self):
+        t = tc.arange(0., 24., step=0.1)
+
+        def float64(variables) :
+            return {name: value.double() for name, value in variables.items()}
+
+        # 닫힌 해는 지수항끼리 상쇄되므로 float32로 계산하면 기준값이 될 수 없다
+        variables = {'k_00': tc.tensor(1.), 'd': tc.tensor(320.), 'r': tc.tensor(160.)}
+        symbolic = odesolver.CompartmentModelGenerator([[True]], is_infusion=True)
+        numeric = odesolver.NumericCompartmentModel([[True]], is_infusion=True)
+        expected = symbolic(t=t.double(), **float64(variables))
+        self.assertTrue(tc.allclose(numeric(t=t, **variables).double(), expected, rtol=1e-4, atol=1e-3))
+        self.assertTrue(tc.allclose(numeric(t=t.double(), **float64(variables)), expected, rtol=1e-8, atol=1e-8))
+
+        variables = {'k_00': tc.tensor(1.5), 'k_12': tc.tensor(0.6), 'k_23': tc.tensor(0.7), 'k_34': tc.tensor(0.8), 'k_40': tc.tensor(0.2), 'd': tc.tensor(320.)}
+        symbolic = odesolver.CompartmentModelGenerator([[True]], has_depot=True, transit = 3, is_infusion=False)
+        numeric = odesolver.NumericCompartmentModel([[True]], has_depot=True, transit = 3, is_infusion=False)
+        expected = symbolic(t=t.double(), **float64(variables))
+        self.assertTrue(tc.allclose(numeric(t=t, **variables).double(), expected, rtol=1e-4, atol=1e-3))
+        self.assertTrue(tc.allclose(numeric(t=t.double(), **float64(variables)), expected, rtol=1e-8, atol=1e-8))
+
+        transit = 12
+        numeric = odesolver.NumericCompartmentModel([[True]], has_depot=True, transit = transit, is_infusion=False)
+        comps_num = transit + 2
+        variables = {odesolver.rate_constant_name(i, i+1, comps_num): tc.full((5,), 0.7) for i in range(1, comps_num - 1)}
+        variables[odesolver.rate_constant_name(0, 0, comps_num)] = tc.linspace(0.1, 0.5, 5)
+        variables[odesolver.rate_constant_name(comps_num - 1, 0, comps_num)] = tc.full((5,), 0.7)
+        variables['d'] = tc.full((5,), 320.)
+        amounts = numeric(t=t, **variables)
+        self.assertEqual(amounts.size(), (comps_num, 5, t.size()[0]))
+        self.assertTrue(tc.allclose(amounts[:, :, 0].sum(0), variables['d']))
+
+    def test_python_number_variables(self):
+        t = tc.arange(0., 24., step=0.1)
+        variables = {'k_00': 1., 'd': 320., 'r': 160.}
+        for model in [odesolver.CompartmentModelGenerator([[True]], is_infusion=True), odesolver.NumericCompartmentModel([[True]], is_infusion=True)] :
+            expected = model(t=t, **{name: tc.tensor(value) for name, value in variables.items()})
+            self.assertTrue(tc.allclose(model(t=t, **variables), expected))
+
+    def test_multiple_doses(self):
+        t = tc.arange(0., 48., step=0.5)
+        dose_times = tc.tensor([[0., 12.], [0., 24.], [6., 30.]])
+        variables = {'k_00': tc.tensor([1., 0.5, 0.2]), 'd': tc.tensor([[320., 160.], [320., 320.], [100., 200.]]), 'r': tc.tensor([[160., 160.], [80., 80.], [50., 50.]])}
+        for model in [odesolver.CompartmentModelGenerator([[True]], is_infusion=True), odesolver.NumericCompartmentModel([[True]], is_infusion=True)] :
+            amounts = model(t=t, dose_times=dose_times, **variables)
+            self.assertEqual(amounts.size(), (1, 3, t.size()[0]))
+
+            for i in range(3) :
+                for j in range(2) :
+                    single_dose = model(t=(t - dose_times[i, j]).clamp(min=0), k_00=variables['k_00'][i], d=variables['d'][i, j], r=variables['r'][i, j])
+                    amounts[:, i] -= single_dose * (t >= dose_times[i, j])
+            self.assertTrue(tc.allclose(amounts, tc.zeros_like(amounts), atol=1e-3))
+
 class BasementModel(predfunction.PredictionFunctionByTime) :
 
+    per_record_eps = True
+
     def _set_estimated_parameters(self):
         self.theta_0 = Theta(0., 5., 10.)
         self.theta_1 = Theta(0., 30., 100.)
@@ -205,6 +449,8 @@ class BasementModel(predfunction.PredictionFunctionByTime) :
 
 class BasementModelFIM(predfunction.PredictionFunctionByTime) :
 
+    per_record_eps = True
+
     def _set_estimated_parameters(self):
         self.theta_0 = Theta(0.01, 2., 10.)
         self.theta_1 = Theta(0.01, 30., 40.)
@@ -238,6 +484,8 @@ class AnnModel(predfunction.PredictionFunctionByTime) :
     '''
         pass
     '''
+    per_record_eps = True
+
     def _set_estimated_parameters(self):
         self.theta_0 = Theta(0., 1.5, 10.)
         self.theta_1 = Theta(0., 30., 100.)
@@ -280,6 +528,8 @@ class AnnModel(predfunction.PredictionFunctionByTime) :
 
 class AmtModel(predfunction.PredictionFunctionByTime) :
 
+    per_record_eps = True
+
     def _set_estimated_parameters(self):
 
         self.theta_0 = Theta(0, 100, 500)
@@ -309,6 +559,8 @@ class AmtModel(predfunction.PredictionFunctionByTime) :
         return y_pred +  y_pred * self.eps_0() + self.eps_1()
 
 class ODEModel(predfunction.PredictionFunctionByODE) :
+    per_record_eps = True
+
     def _set_estimated_parameters(self):
         self.theta_0 = Theta(0., 1.5, 10)
         self.theta_1 = Theta(0, 30, 100)
@@ -337,6 +589,45 @@ class ODEModel(predfunction.PredictionFunctionByODE) :
         y = y_pred/parameters['v']
         return y +  y * self.eps_0() + self.eps_1()
         
+class BatchODEModel(ODEModel) :
+    rtol = 1e-6
+    atol = 1e-6
+
+    def _calculate_preds(self, t, y, p) -> tc.Tensor :
+        return tc.stack([-p['k_a'] * y[0], p['k_a'] * y[0] - p['k_e'] * y[1]])
+
+class CheckpointODEModel(BatchODEModel) :
+    checkpoint_integration = True
+
+class SensitivityODEModel(BatchODEModel) :
+    forward_sensitivity = True
+
+class EventODEModel(BatchODEModel) :
+    event_integration = True
+
+class RosenbrockODEModel(BatchODEModel) :
+    solver = 'rosenbrock'
+
+class StiffODEModel(EventODEModel) :
+    rtol = 1e-4
+    atol = 1e-4
+
+    def _calculate_parameters(self, p):
+        super()._calculate_parameters(p)
+        p['k_a'] = p['k_a'] * 200
+
+class StiffRosenbrockODEModel(StiffODEModel) :
+    solver = 'rosenbrock'
+
+class LinearODEModel(ODEModel) :
+    linear = True
+
+    def _calculate_rate_matrix(self, p) :
+        zero = tc.zeros_like(p['k_a'])
+        rate_matrix = tc.stack([tc.stack([-p['k_a'], zero]),
+                                tc.stack([p['k_a'], -p['k_e']])])
+        return rate_matrix, tc.stack([zero, zero])
+
 class TotalTest(unittest.TestCase) :
 
     def setUp(self):
@@ -576,4 +867,519 @@ class TotalTest(unittest.TestCase) :
         r = searcher.run(tolerance_grad=1e-3, tolerance_change=1e-3)
         history = r['history']
         for record in history :
-            print(record)
\ No newline at end of file
+            print(record)
+
+class PartialDifferentiationTest(unittest.TestCase) :
+
+    def test_partial_differentiate(self):
+        dataset_file_path = './examples/THEO.csv'
+        dataset_np = np.loadtxt(dataset_file_path, delimiter=',', dtype=np.float32, skiprows=1)
+        column_names = ['ID', 'AMT', 'TIME', 'DV', 'CMT', "MDV", "RATE", 'BWT']
+        dataset = CSVDataset(dataset_np, column_names)
+
+        model = models.FOCEInter(dataset = dataset,
+                                output_column_names= ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = BasementModel, 
+                                theta_names=['theta_0', 'theta_1', 'theta_2'],
+                                eta_names= ['eta_0', 'eta_1','eta_2'], 
+                                eps_names= ['eps_0','eps_1'], 
+                                omega=Omega([0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205], False), 
+                                sigma=Sigma([[0.0177], [0.0762]], [True, True]))
+
+        data, _ = dataset[0]
+        pred_output = model.pred_function(data)
+        y_pred = pred_output['y_pred']
+        eta = [pred_output['etas'][name]() for name in model.eta_names]
+        eps = [pred_output['epss'][name]() for name in model.eps_names]
+
+        _, g, h = model._partial_differentiate(y_pred, eta, eps, by_etas = True, by_epss = True)
+
+        for i, y_pred_elem in enumerate(y_pred) :
+            for j, cur_eta in enumerate(eta) :
+                g_elem = tc.autograd.grad(y_pred_elem, cur_eta, retain_graph=True)[0]
+                self.assertTrue(tc.allclose(g[i, j], g_elem))
+            for j, cur_eps in enumerate(eps) :
+                h_elem = tc.autograd.grad(y_pred_elem, cur_eps, retain_graph=True)[0][i]
+                self.assertTrue(tc.allclose(h[i, j], h_elem))
+        
+        self.assertTrue(g.requires_grad)
+
+    def test_per_record_eps(self):
+        dataset_file_path = './examples/THEO.csv'
+        dataset_np = np.loadtxt(dataset_file_path, delimiter=',', dtype=np.float32, skiprows=1)
+        column_names = ['ID', 'AMT', 'TIME', 'DV', 'CMT', "MDV", "RATE", 'BWT']
+        dataset = CSVDataset(dataset_np, column_names)
+
+        model = models.FOCEInter(dataset = dataset,
+                                output_column_names= ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = BasementModel, 
+                                theta_names=['theta_0', 'theta_1', 'theta_2'],
+                                eta_names= ['eta_0', 'eta_1','eta_2'], 
+                                eps_names= ['eps_0','eps_1'], 
+                                omega=Omega([0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205], False), 
+                                sigma=Sigma([[0.0177], [0.0762]], [True, True]))
+
+        # 다른 record의 eps에 의존하는 모델도 정확한 h를 얻도록 기본값은 false이다
+        self.assertFalse(predfunction.PredictionFunction.per_record_eps)
+
+        data, _ = dataset[0]
+        model.pred_function.per_record_eps = True
+        _, _, _, _, h_diagonal, _, _, _, _ = model(data)
+        model.pred_function.per_record_eps = False
+        _, _, _, _, h_dense, _, _, _, _ = model(data)
+
+        self.assertEqual(h_diagonal.size(), h_dense.size())
+        self.assertTrue(tc.allclose(h_diagonal, h_dense))
+
+def get_multiple_dose_dataset_np() :
+    dataset_np = np.loadtxt('./examples/THEO.csv', delimiter=',', dtype=np.float32, skiprows=1)
+    column_names = ['ID', 'AMT', 'TIME', 'DV', 'CMT', "MDV", "RATE", 'BWT']
+
+    second_dose = dataset_np[dataset_np[:, 0] == 2][3].copy()
+    second_dose[column_names.index('AMT')] = 4.
+    second_dose[column_names.index('MDV')] = 1
+    second_dose[column_names.index('DV')] = 0
+    dataset_np = np.concatenate([dataset_np, second_dose[None]])
+    return dataset_np[np.lexsort((dataset_np[:, 2], dataset_np[:, 0]))], column_names
+
+class BatchedForwardTest(unittest.TestCase) :
+
+    def test_forward_batch(self):
+        dataset_np, column_names = get_multiple_dose_dataset_np()
+        dataset = CSVDataset(dataset_np, column_names, padded=True)
+
+        model = models.FOCEInter(dataset = dataset,
+                                output_column_names= ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = AmtModel, 
+                                theta_names=['theta_0'],
+                                eta_names= ['eta_0', 'eta_1','eta_2'], 
+                                eps_names= ['eps_0','eps_1'], 
+                                omega=Omega([0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205], False), 
+                                sigma=Sigma([[0.0177], [0.0762]], [True, True]))
+
+        y_pred_batch, eta_batch, _, g_batch, h_batch, _, _, mdv_mask_batch, output_columns_batch = model.forward_batch(dataset.padded_dataset)
+
+        for i, (data, _) in enumerate(dataset) :
+            y_pred, eta, _, g, h, _, _, mdv_mask, output_columns = model(data)
+            length = data.size()[0]
+
+            self.assertTrue(tc.allclose(y_pred_batch[i, :length], y_pred, atol=1e-5))
+            self.assertTrue(tc.allclose(g_batch[i, :length], g, atol=1e-5))
+            self.assertTrue(tc.allclose(h_batch[i, :length], h, atol=1e-5))
+            self.assertTrue(tc.allclose(eta_batch[i], eta))
+            self.assertTrue(tc.equal(mdv_mask_batch[i, :length], mdv_mask))
+            self.assertFalse(mdv_mask_batch[i, length:].any())
+            self.assertTrue(tc.allclose(output_columns_batch['k_a'][i, :length], output_columns['k_a']))
+
+        optimizer = tc.optim.LBFGS(model.parameters())
+        loss_batch = model.optimization_function_closure_batch(dataset, optimizer)()
+        loss = model.optimization_function_closure(dataset, optimizer)()
+        self.assertTrue(tc.allclose(loss_batch, loss))
+
+    def test_objective_function_batch(self):
+        dataset_np, column_names = get_multiple_dose_dataset_np()
+        dataset = CSVDataset(dataset_np, column_names, padded=True)
+
+        model = models.FOCEInter(dataset = dataset,
+                                output_column_names= ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = AmtModel, 
+                                theta_names=['theta_0'],
+                                eta_names= ['eta_0', 'eta_1','eta_2'], 
+                                eps_names= ['eps_0','eps_1'], 
+                                omega=Omega([0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205], False), 
+                                sigma=Sigma([[0.0177], [0.0762]], [True, True]))
+
+        y_pred, eta, _, g, h, omega, sigma, mdv_mask, _ = model.forward_batch(dataset.padded_dataset)
+        y_true = dataset.padded_y_true
+
+        losses, total_loss = model.objective_function.batch(y_true, y_pred, g, h, eta, omega, sigma, mdv_mask)
+        for i, mask in enumerate(mdv_mask) :
+            loss_value = model.objective_function(y_true[i][mask], y_pred[i][mask], g[i][mask], h[i][mask], eta[i], omega, sigma)
+            self.assertTrue(tc.allclose(losses[i], loss_value, rtol=1e-4))
+        self.assertTrue(tc.allclose(total_loss, losses.sum()))
+
+        objective_function = loss.FOCEObjectiveFunction()
+        losses, _ = objective_function.batch(y_true, y_pred, g, h, eta, omega, sigma, mdv_mask)
+        cwres_values = misc.cwres_batch(y_true, y_pred, g, h, eta, omega, sigma, mdv_mask)
+        for i, mask in enumerate(mdv_mask) :
+            loss_value = objective_function(y_true[i][mask], y_pred[i][mask], g[i][mask], h[i][mask], eta[i], omega, sigma)
+            self.assertTrue(tc.allclose(losses[i], loss_value, rtol=1e-4))
+
+            cwres_value = misc.cwres(y_true[i][mask], y_pred[i][mask], g[i][mask], h[i][mask], eta[i], omega, sigma)
+            self.assertTrue(tc.allclose(cwres_values[i][mask], cwres_value, atol=1e-5))
+            self.assertFalse(cwres_values[i][~mask].any())
+
+            # whitened_residuals를 거치지 않고 C를 float64로 직접 만들어 확인한다
+            g_i, h_i, eta_i = g[i][mask].double(), h[i][mask].double(), eta[i].double()
+            c = g_i @ omega.double() @ g_i.t() + (h_i @ sigma.double() @ h_i.t()).diag().diag()
+            res = (y_true[i][mask] - y_pred[i][mask]).double() + g_i @ eta_i
+            cwres_value = cwres_values[i][mask].double()
+
+            # 제곱합은 res^T C^-1 res이고, 대칭 제곱근으로 구한 예전 CWRES와는 회전만 다르다
+            self.assertTrue(tc.allclose(cwres_value.square().sum(), res @ tc.linalg.solve(c, res), rtol=1e-3))
+            self.assertTrue(tc.allclose(cwres_value.norm(), (misc.mat_sqrt_inv(c) @ res).norm(), rtol=1e-3))
+            expected = tc.linalg.solve_triangular(tc.linalg.cholesky(c), res.unsqueeze(-1), upper=False).squeeze(-1)
+            self.assertTrue(tc.allclose(cwres_value, expected, rtol=1e-3, atol=1e-3))
+
+class ParameterStorageTest(unittest.TestCase) :
+
+    def _get_model(self) :
+        dataset_np = np.loadtxt('./examples/THEO.csv', delimiter=',', dtype=np.float32, skiprows=1)
+        column_names = ['ID', 'AMT', 'TIME', 'DV', 'CMT', "MDV", "RATE", 'BWT']
+        dataset = CSVDataset(dataset_np, column_names)
+        return models.FOCEInter(dataset = dataset,
+                                output_column_names= ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = BasementModel, 
+                                theta_names=['theta_0', 'theta_1', 'theta_2'],
+                                eta_names= ['eta_0', 'eta_1','eta_2'], 
+                                eps_names= ['eps_0','eps_1'], 
+                                omega=Omega([0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205], False), 
+                                sigma=Sigma([[0.0177], [0.0762]], [True, True]))
+
+    def test_eta_storage(self):
+        model = self._get_model()
+        subject_size = len(model.pred_function.dataset)
+
+        state = model.state_dict()
+        self.assertEqual(state['pred_function.eta_0.parameter_values'].size(), tc.Size([subject_size]))
+
+        with tc.no_grad() :
+            model.pred_function.eta_1.parameter_values[3] = 0.5
+        data, _ = model.pred_function.dataset[3]
+        _, eta, _, _, _, _, _, _, _ = model(data)
+        self.assertAlmostEqual(float(eta[1].detach()), 0.5)
+
+        simulation_dataset_np = np.loadtxt('./examples/THEO.csv', delimiter=',', dtype=np.float32, skiprows=1)
+        simulation_dataset_np[:, 0] += 100
+        simulation_dataset = CSVDataset(simulation_dataset_np, model.pred_function.dataset.column_names)
+        eta_parameter = model.pred_function.eta_0.parameter_values
+        result = model.simulate(simulation_dataset, 2)
+        self.assertEqual(len(result), subject_size)
+
+        # simulation subject는 scratch subject이므로 parameter와 state_dict는 그대로이다
+        self.assertIs(model.pred_function.eta_0.parameter_values, eta_parameter)
+        self.assertEqual(model.pred_function.eta_0.parameter_values.size(), tc.Size([subject_size]))
+        self.assertEqual(model.pred_function.eps_0.parameter_values.size(), state['pred_function.eps_0.parameter_values'].size())
+        self.assertNotIn('101', model.pred_function._subject_indice)
+        with self.assertRaises(Exception) :
+            model.pred_function._get_subject_index('101', 3)
+
+    def test_scratch_eta_index(self):
+        eta = Eta()
+        eta.parameter_values = nn.Parameter(tc.tensor([1., 2.]))
+        eta.scratch_values = tc.tensor([3., 4.])
+
+        # scratch subject가 있어도 두 저장소를 합치지 않고 각각에서 고른다
+        eta.set_index(1)
+        self.assertEqual(eta().data_ptr(), eta.parameter_values[1].data_ptr())
+        eta.set_index(3)
+        self.assertEqual(eta().data_ptr(), eta.scratch_values[1].data_ptr())
+        eta.set_index(tc.tensor([3, 0, 2]))
+        self.assertTrue(tc.equal(eta(), tc.tensor([4., 1., 3.])))
+
+    def test_eps_storage(self):
+        model = self._get_model()
+        dataset = model.pred_function.dataset
+        total_record_length = sum(data.size()[0] for data, _ in dataset)
+
+        state = model.state_dict()
+        self.assertEqual(state['pred_function.eps_0.parameter_values'].size(), tc.Size([total_record_length]))
+
+        data, _ = dataset[2]
+        model(data)
+        eps = model.pred_function.eps_0()
+        self.assertEqual(eps.size()[0], data.size()[0])
+        self.assertEqual(eps.data_ptr(), model.pred_function.eps_0.parameter_values[model.pred_function._get_record_slice('3')].data_ptr())
+
+        model.simulate(dataset, 1)
+        self.assertTrue((model.pred_function.eps_0.parameter_values != 0).any())
+        model.pred_function.reset_epss()
+        self.assertFalse((model.pred_function.eps_0.parameter_values != 0).any())
+
+    def test_scratch_eps_index(self):
+        eps = Eps()
+        eps.parameter_values = tc.tensor([1., 2., 3.])
+        eps.scratch_values = tc.tensor([4., 5.])
+
+        # scratch record의 slice는 scratch_values의 view이다
+        eps.set_index(slice(3, 5))
+        self.assertEqual(eps().data_ptr(), eps.scratch_values.data_ptr())
+        self.assertTrue(tc.equal(eps().detach(), tc.tensor([4., 5.])))
+        eps.set_index(slice(0, 2))
+        self.assertTrue(tc.equal(eps().detach(), tc.tensor([1., 2.])))
+
+        index = tc.tensor([[0, 3], [1, 4], [2, 4]])
+        mask = tc.tensor([[True, True], [True, True], [True, False]])
+        eps.set_index(index, mask)
+        self.assertTrue(tc.equal(eps().detach(), tc.tensor([[1., 4.], [2., 5.], [3., 0.]])))
+
+class VectorizedSuperpositionTest(unittest.TestCase) :
+
+    def test_vectorized_superposition(self):
+        dataset_np, column_names = get_multiple_dose_dataset_np()
+        dataset = CSVDataset(dataset_np, column_names, padded=True)
+
+        model = models.FOCEInter(dataset = dataset,
+                                output_column_names= ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = AmtModel, 
+                                theta_names=['theta_0'],
+                                eta_names= ['eta_0', 'eta_1','eta_2'], 
+                                eps_names= ['eps_0','eps_1'], 
+                                omega=Omega([0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205], False), 
+                                sigma=Sigma([[0.0177], [0.0762]], [True, True]))
+
+        y_pred_batch, _, _, g_batch, _, _, _, _, _ = model.forward_batch(dataset.padded_dataset)
+        model.pred_function.vectorized_superposition = True
+        y_pred_batch_vectorized, _, _, g_batch_vectorized, _, _, _, _, _ = model.forward_batch(dataset.padded_dataset)
+
+        self.assertTrue(tc.allclose(y_pred_batch, y_pred_batch_vectorized, atol=1e-5))
+        self.assertTrue(tc.allclose(g_batch, g_batch_vectorized, atol=1e-5))
+
+        for i, (data, _) in enumerate(dataset) :
+            model.pred_function.vectorized_superposition = False
+            y_pred, _, _, g, _, _, _, _, _ = model(data)
+            model.pred_function.vectorized_superposition = True
+            y_pred_vectorized, _, _, g_vectorized, _, _, _, _, _ = model(data)
+
+            self.assertTrue(tc.allclose(y_pred, y_pred_vectorized, atol=1e-5))
+            self.assertTrue(tc.allclose(g, g_vectorized, atol=1e-5))
+
+def get_ode_dataset_np() :
+    dataset_np = np.loadtxt('./examples/THEO_ODE.csv', delimiter=',', dtype=np.float32, skiprows=1)
+    column_names = ['ID', 'TIME', 'AMT', 'RATE', 'DV', 'MDV', 'CMT', 'COV']
+    return dataset_np, column_names
+
+def get_infusion_ode_dataset_np() :
+    dataset_np, column_names = get_ode_dataset_np()
+
+    dataset_np[(dataset_np[:, 0] == 1) & (dataset_np[:, 2] > 0), 3] = 160.
+    second_dose = dataset_np[dataset_np[:, 0] == 2][5].copy()
+    second_dose[[2, 4, 5, 6]] = [100., 0., 1., 0.]
+    dataset_np = np.concatenate([dataset_np, second_dose[None]])
+    return dataset_np[np.lexsort((dataset_np[:, 1], dataset_np[:, 0]))], column_names
+
+class ODEModelTestCase(unittest.TestCase) :
+    """
+    ODE models of theophylline on the infusion dataset, solvers of them are compared with the integration by odeint of BatchODEModel.
+    """
+
+    def setUp(self):
+        dataset_np, column_names = get_infusion_ode_dataset_np()
+        self.dataset = CSVDataset(dataset_np, column_names, padded=True)
+
+    def _get_model(self, pred_function, dataset = None) :
+        dataset = self.dataset if dataset is None else dataset
+        return models.FOCEInter(dataset = dataset,
+                                output_column_names = dataset.column_names + ['k_a', 'v', 'k_e'],
+                                pred_function = pred_function, 
+                                theta_names = ['theta_0', 'theta_1', 'theta_2'],
+                                eta_names = ['eta_0', 'eta_1','eta_2'], 
+                                eps_names = ['eps_0','eps_1'], 
+                                omega = Omega([[0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205]], [False]), 
+                                sigma = Sigma([[0.0177, 0.0762]], [True]))
+
+    def _forward(self, pred_function) :
+        """
+        y_pred, g, h of the batch and y_pred, g of the first subject
+        """
+        model = self._get_model(pred_function)
+        y_pred, _, _, g, h, _, _, _, _ = model.forward_batch(self.dataset.padded_dataset)
+        data, _ = self.dataset[0]
+        y_pred_subject, _, _, g_subject, _, _, _, _, _ = model(data)
+        return y_pred, g, h, y_pred_subject, g_subject
+
+    def assertForwardClose(self, pred_function, expected_pred_function = None, atol = 1e-5) :
+        expected_pred_function = BatchODEModel if expected_pred_function is None else expected_pred_function
+        for expected, actual in zip(self._forward(expected_pred_function), self._forward(pred_function)) :
+            self.assertTrue(tc.allclose(expected, actual, atol=atol))
+
+    def assertBatchClose(self, model, dataset, atol) :
+        """
+        batched forward of model is the same as the forward of each subject
+        """
+        y_pred_batch, _, _, g_batch, h_batch, _, _, _, _ = model.forward_batch(dataset.padded_dataset)
+
+        for i, (data, _) in enumerate(dataset) :
+            y_pred, _, _, g, h, _, _, _, _ = model(data)
+            length = data.size()[0]
+
+            self.assertTrue(tc.allclose(y_pred_batch[i, :length], y_pred, atol=atol))
+            self.assertTrue(tc.allclose(g_batch[i, :length], g, atol=atol))
+            self.assertTrue(tc.allclose(h_batch[i, :length], h, atol=atol))
+
+class BatchedODETest(ODEModelTestCase) :
+
+    def test_forward_batch(self):
+        dataset_np, column_names = get_ode_dataset_np()
+        dataset = CSVDataset(dataset_np, column_names, padded=True)
+        self.assertBatchClose(self._get_model(BatchODEModel, dataset), dataset, atol=1e-4)
+
+    def test_shared_infusion_end_time(self):
+        dataset_np, column_names = get_ode_dataset_np()
+
+        # 세 subject가 모두 2시간 동안 주입되어 주입 종료 시간이 같다
+        infused = np.isin(dataset_np[:, 0], [1, 2, 3]) & (dataset_np[:, 2] > 0)
+        dataset_np[infused, 3] = dataset_np[infused, 2] / 2
+        dataset = CSVDataset(dataset_np, column_names, padded=True)
+
+        self.assertBatchClose(self._get_model(BatchODEModel, dataset), dataset, atol=1e-4)
+
+class CheckpointIntegrationTest(ODEModelTestCase) :
+
+    def test_checkpoint_integration(self):
+        self.assertForwardClose(CheckpointODEModel, atol=1e-5)
+
+    def _saved_tensor_size(self, pred_function, tolerance) :
+        """
+        number of tensors saved for backward by the batched forward of pred_function
+        """
+        model = self._get_model(pred_function)
+        model.pred_function.rtol = model.pred_function.atol = tolerance
+        saved_tensors = []
+        with tc.autograd.graph.saved_tensors_hooks(lambda tensor : saved_tensors.append(tensor) or tensor, lambda tensor : tensor) :
+            model.pred_function.forward_batch(self.dataset.padded_dataset)
+        return len(saved_tensors)
+
+    def test_saved_tensors(self):
+        # 허용 오차를 줄이면 step이 늘어나지만, checkpoint는 step 수와 무관하게 구간 입력만 저장한다
+        loose, tight = 1e-2, 1e-6
+        self.assertGreater(self._saved_tensor_size(BatchODEModel, tight), self._saved_tensor_size(BatchODEModel, loose))
+        self.assertEqual(self._saved_tensor_size(CheckpointODEModel, tight), self._saved_tensor_size(CheckpointODEModel, loose))
+        self.assertLess(self._saved_tensor_size(CheckpointODEModel, tight), self._saved_tensor_size(BatchODEModel, tight))
+
+class ForwardSensitivityTest(ODEModelTestCase) :
+
+    def test_forward_sensitivity(self):
+        self.assertForwardClose(SensitivityODEModel, atol=1e-3)
+
+class EventIntegrationTest(ODEModelTestCase) :
+
+    def test_event_integration(self):
+        self.assertForwardClose(EventODEModel, atol=1e-3)
+        self.assertBatchClose(self._get_model(EventODEModel), self.dataset, atol=1e-3)
+
+    def test_float64_dataset(self):
+        # float64 dataset의 상태는 float64로 적분되어야 한다
+        dataset_np, column_names = get_infusion_ode_dataset_np()
+        dataset = CSVDataset(dataset_np.astype(np.float64), column_names, padded=True)
+        y_pred, _, _, _, _, _, _, _, _ = self._get_model(EventODEModel, dataset).forward_batch(dataset.padded_dataset)
+        expected, _, _, _, _, _, _, _, _ = self._get_model(BatchODEModel).forward_batch(self.dataset.padded_dataset)
+
+        self.assertEqual(y_pred.dtype, tc.float64)
+        self.assertTrue(tc.allclose(y_pred.float(), expected, atol=1e-3))
+
+    def test_non_finite_step(self):
+        model = self._get_model(EventODEModel)
+        model.pred_function.ode_function = lambda t, y : y * float('nan')
+        with self.assertRaises(Exception) :
+            model.forward_batch(self.dataset.padded_dataset)
+
+class RosenbrockSolverTest(ODEModelTestCase) :
+
+    def test_rosenbrock_solver(self):
+        self.assertForwardClose(RosenbrockODEModel, atol=1e-3)
+
+    def test_invalid_options(self):
+        for options in [{'solver': 'rosenbrock', 'forward_sensitivity': True},
+                        {'solver': 'rosenbrock', 'checkpoint_integration': True},
+                        {'event_integration': True, 'checkpoint_integration': True}] :
+            pred_function = type('InvalidODEModel', (BatchODEModel,), options)
+            with self.assertRaises(Exception) :
+                self._get_model(pred_function)
+
+    def _stiff_forward(self, pred_function) :
+        """
+        y_pred of the first subject and the number of solver steps
+        """
+        dataset_np, column_names = get_ode_dataset_np()
+        dataset = CSVDataset(dataset_np[dataset_np[:, 0] == 1], column_names, padded=True)
+        model = self._get_model(pred_function, dataset)
+
+        steps = []
+        step_name = {'dopri5': '_dopri5_step', 'rosenbrock': '_rosenbrock_step'}[pred_function.solver]
+        step_function = getattr(model.pred_function, step_name)
+        setattr(model.pred_function, step_name, lambda *args : steps.append(1) or step_function(*args))
+
+        with tc.no_grad() :
+            y_pred = model.pred_function.forward_batch(dataset.padded_dataset)['y_pred']
+        return y_pred, len(steps)
+
+    def test_stiff_model(self):
+        # 흡수가 소실보다 수천 배 빠르면 dopri5는 안정성 때문에 step이 작아진다
+        y_pred_dopri5, steps_dopri5 = self._stiff_forward(StiffODEModel)
+        y_pred_rosenbrock, steps_rosenbrock = self._stiff_forward(StiffRosenbrockODEModel)
+
+        self.assertTrue(tc.allclose(y_pred_dopri5, y_pred_rosenbrock, rtol=1e-2, atol=1e-2))
+        self.assertLess(steps_rosenbrock * 5, steps_dopri5)
+
+class ODEToleranceScheduleTest(ODEModelTestCase) :
+
+    def setUp(self):
+        dataset_np, column_names = get_ode_dataset_np()
+        self.dataset = CSVDataset(dataset_np, column_names)
+
+    def _fit(self, ode_tolerance_schedule) :
+        """
+        total loss of the model fitted with ode_tolerance_schedule
+        """
+        model = self._get_model(BatchODEModel)
+        model.fit_population(tolerance_grad = 1e-3, tolerance_change = 1e-3, max_iteration = 100,
+                             ode_tolerance_schedule = ode_tolerance_schedule)
+
+        self.assertEqual(model.pred_function.rtol, BatchODEModel.rtol)
+        self.assertEqual(model.pred_function.atol, BatchODEModel.atol)
+        return sum(float(values['loss']) for values in model.evaluate().values())
+
+    def test_ode_tolerance_schedule(self):
+        loss_strict = self._fit(None)
+        loss_scheduled = self._fit([(1e-2, 1e-2, 1.), (1e-4, 1e-4, 1e-1)])
+        self.assertAlmostEqual(loss_scheduled, loss_strict, delta = abs(loss_strict) * 1e-2)
+
+    def test_interrupted_schedule(self):
+        model = self._get_model(BatchODEModel)
+
+        def interrupt(*args, **kwargs) :
+            raise KeyboardInterrupt()
+        model.optimization_function_closure = interrupt
+
+        with self.assertRaises(KeyboardInterrupt) :
+            model.fit_population(ode_tolerance_schedule = [(1e-2, 1e-2, 1.)])
+
+        self.assertEqual(model.pred_function.rtol, BatchODEModel.rtol)
+        self.assertEqual(model.pred_function.atol, BatchODEModel.atol)
+
+class DistributedCovarianceStepTest(unittest.TestCase) :
+
+    def test_distributed_covariance_step(self):
+        dataset_np = np.loadtxt('./examples/THEO.csv', delimiter=',', dtype=np.float32, skiprows=1)
+        column_names = ['ID', 'AMT', 'TIME', 'DV', 'CMT', "MDV", "RATE", 'BWT']
+        dataset = CSVDataset(dataset_np, column_names)
+
+        model = models.FOCEInter(dataset = dataset,
+                                output_column_names = ['ID', 'TIME', 'AMT', 'k_a', 'v', 'k_e'],
+                                pred_function = BasementModel, 
+                                theta_names = ['theta_0', 'theta_1', 'theta_2'],
+                                eta_names = ['eta_0', 'eta_1','eta_2'], 
+                                eps_names = ['eps_0','eps_1'], 
+                                omega = Omega([0.4397, 0.0575, 0.0198, -0.0069, 0.0116, 0.0205], False), 
+                                sigma = Sigma([[0.0177], [0.0762]], [True, True]))
+
+        expected = model.covariance_step()
+
+        with tempfile.TemporaryDirectory() as directory :
+            dist.init_process_group('gloo', init_method='file://' + os.path.join(directory, 'store'), rank=0, world_size=1)
+            try :
+                partitioner = data.DataPartitioner(dataset, [len(dataset)], [tc.device('cpu')])
+                result = model.covariance_step(partitioner.use(0), distributed=True)
+            finally :
+                dist.destroy_process_group()
+
+        self.assertTrue(tc.allclose(expected['cov'], result['cov']))
+
+class MatrixExponentialTest(ODEModelTestCase) :
+
+    def test_linear_model(self):
+        self.assertForwardClose(LinearODEModel, atol=1e-4)
+
+        model = self._get_model(LinearODEModel)
+        self.assertBatchClose(model, self.dataset, atol=1e-5)
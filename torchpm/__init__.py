@@ -1 +1 @@
-__all__ = ['data', 'odesolver', 'loss', 'misc', 'models', 'predfunction', 'covariate']
\ No newline at end of file
+__all__ = ['data', 'odesolver', 'loss', 'misc', 'models', 'predfunction', 'covariate', 'design']
\ No newline at end of file
@@ -18,6 +18,19 @@ class CSVDataset(tc.utils.data.Dataset):
 
         device: (optional) data loaded location 
 
+        padded: (optional) whether to make padded tensors of whole subjects for batched computation
+
+    Attributes:
+
+        padded_dataset: records of subjects sized [subjects, max records, columns],
+            padded records are copies of the last record of each subject with AMT, RATE = 0 and MDV = 1
+
+        padded_y_true: DV of subjects sized [subjects, max records]
+
+        record_lengths: record length of each subject
+
+        record_mask: mask of the real records sized [subjects, max records]
+
     """
     
 
@@ -27,7 +40,9 @@ class CSVDataset(tc.utils.data.Dataset):
 
                  column_names : List[str],
 
-                 device : tc.device = tc.device("cpu")):
+                 device : tc.device = tc.device("cpu"),
+
+                 padded : bool = False):
 
         self.column_names = column_names
 
@@ -56,6 +71,41 @@ class CSVDataset(tc.utils.data.Dataset):
 
         self.len = len(self.dataset)
 
+        self.padded = padded
+
+        if padded :
+
+            self._set_padded_dataset(dataset_np)
+
+
+    def _set_padded_dataset(self, dataset_np : List[np.ndarray]):
+
+        record_lengths = np.array([data_np.shape[0] for data_np in dataset_np])
+
+        max_record_length = record_lengths.max()
+
+        padded_dataset_np = []
+
+        for data_np in dataset_np :
+
+            padding = np.repeat(data_np[-1:], max_record_length - data_np.shape[0], axis=0)
+
+            for column_name, value in [('AMT', 0), ('RATE', 0), ('MDV', 1)] :
+
+                if column_name in self.column_names :
+
+                    padding[:, self.column_names.index(column_name)] = value
+
+            padded_dataset_np.append(np.concatenate([data_np, padding], axis=0))
+
+        self.padded_dataset = tc.from_numpy(np.stack(padded_dataset_np)).to(self.device)
+
+        self.padded_y_true = self.padded_dataset[:, :, self.column_names.index('DV')]
+
+        self.record_lengths = tc.from_numpy(record_lengths).to(self.device)
+
+        self.record_mask = tc.arange(max_record_length, device=self.device).unsqueeze(0) < self.record_lengths.unsqueeze(1)
+
 
     def __getitem__(self, index):
 
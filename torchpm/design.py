@@ -0,0 +1,176 @@
+from typing import Callable, Dict, List, Optional, Sequence
+import torch as tc
+
+from .models import FOCEInter
+
+def candidate_schedules(grid : tc.Tensor, sample_size : int) -> tc.Tensor :
+    """
+    sampling schedules of all combinations of candidate sampling times
+    Args:
+        grid: candidate sampling times sized [times]
+        sample_size: sampling times of a schedule
+    Returns:
+        schedules sized [schedules, sample_size]
+    """
+    return tc.combinations(grid, r=sample_size)
+
+def make_design_dataset(template : tc.Tensor, column_names : List[str], schedules : tc.Tensor, id : int) -> tc.Tensor :
+    """
+    padded records of designs, dose records of template and observation records at the times of each schedule
+    Args:
+        template: records of a subject sized [records, columns], its dose records and covariates are used.
+        column_names: column names of template
+        schedules: sampling times sized [designs, samples]
+        id: ID of the records of designs
+    Returns:
+        records of designs sorted by TIME sized [designs, doses + samples, columns]
+    """
+    amt_index = column_names.index('AMT')
+    mdv_index = column_names.index('MDV')
+    time_index = column_names.index('TIME')
+
+    dose_records = template[template[:, amt_index] != 0]
+    observation_records = template[template[:, mdv_index] == 0]
+    observation_record = observation_records[0] if observation_records.size()[0] > 0 else template[0]
+
+    design_size, sample_size = schedules.size()
+    observation_record = observation_record.clone()
+    observation_record[[amt_index, column_names.index('RATE'), column_names.index('DV'), mdv_index]] = 0
+    observation_records = observation_record.repeat(design_size, sample_size, 1)
+    observation_records[:, :, time_index] = schedules
+
+    records = tc.cat([dose_records.expand(design_size, *dose_records.size()), observation_records], dim=1)
+    records[:, :, column_names.index('ID')] = id
+
+    # 같은 시간이면 투약 기록이 관측 기록보다 앞선다, stable argsort 대신 시간의 순위와 원래 위치로 만든 정수 key로 정렬한다
+    _, time_rank = tc.unique(records[:, :, time_index], return_inverse=True)
+    record_size = records.size()[1]
+    order = tc.argsort(time_rank * record_size + tc.arange(record_size, device=records.device), dim=1)
+    return records.gather(1, order.unsqueeze(-1).expand_as(records))
+
+class FedorovExchange :
+    """
+    search of sampling schedules of subjects among candidate schedules by Fedorov exchange.
+    fisher information matrices of all candidate schedules are computed by a batched forward once,
+    the criterion of the population design is updated by adding and removing them.
+    Args:
+        model: model of the fisher information matrix, its design_optimal_function is the criterion.
+        template: records of a subject sized [records, columns], its dose records and covariates are used.
+        schedules: candidate sampling times sized [schedules, samples]
+        jitter: added to the diagonal of the fisher information matrix of the population design
+        criterion_arguments: (optional) function of fisher information matrices sized [..., *matrix size],
+            returns the arguments of the criterion after the fisher information matrices,
+            e.g. lambda m: (m[..., 1:, 1:],) for DSOptimality or lambda m: (reference, 3) for DEffectivenessOptimality.
+    Attributes:
+        fisher_information_matrices: fisher information matrices of schedules sized [schedules, *matrix size]
+    """
+
+    design_id : int = -1
+
+    def __init__(self, model : FOCEInter, template : tc.Tensor, schedules : tc.Tensor, jitter : float = 1e-6, criterion_arguments : Optional[Callable[[tc.Tensor], Sequence]] = None) :
+        self.model = model
+        self.schedules = schedules
+        self.jitter = jitter
+        self.criterion_arguments = criterion_arguments
+
+        pred_function = model.pred_function
+        dataset = make_design_dataset(template, pred_function._column_names, schedules, self.design_id)
+
+        # 설계 subject는 scratch subject로 추가되고, eta는 0으로 둔다
+        with pred_function.scratch_subjects() :
+            subject_index = pred_function._get_subject_index(str(self.design_id), dataset.size()[1])
+            for name, eta in pred_function.get_etas().items() :
+                eta.assign(subject_index, 0.)
+
+            self.fisher_information_matrices = model.fisher_information_matrix_batch(dataset).detach()
+
+    def _losses(self, fisher_information_matrix : tc.Tensor) -> tc.Tensor :
+        """
+        losses of the design optimal function by adding each candidate to fisher_information_matrix
+        """
+        criterion = self.model.design_optimal_function
+
+        # 모든 후보의 행렬을 한 번의 batched 분해로 평가한다
+        fisher_information_matrices = fisher_information_matrix + self.fisher_information_matrices
+        if self.criterion_arguments is None :
+            return criterion(fisher_information_matrices)
+        return criterion(fisher_information_matrices, *self.criterion_arguments(fisher_information_matrices))
+
+    def greedy(self, subject_size : int) -> Dict[str, tc.Tensor] :
+        """
+        schedules of subjects added one by one, each of them is the best for the subjects selected before.
+        Args:
+            subject_size: number of subjects of the design
+        Returns:
+            indice, schedules, loss and fisher_information_matrix of the design
+        """
+        candidates = self.fisher_information_matrices
+        eye = tc.eye(candidates.size()[-1], device=candidates.device, dtype=candidates.dtype)
+
+        fisher_information_matrix = eye * self.jitter
+        indice = []
+        for _ in range(subject_size) :
+            losses = self._losses(fisher_information_matrix)
+            index = int(losses.argmin())
+            indice.append(index)
+            fisher_information_matrix = fisher_information_matrix + candidates[index]
+
+        return self._result(indice, losses[index])
+
+    def exchange(self, subject_size : int, indice : Optional[List[int]] = None, max_iteration : int = 100, tolerance_change : float = 1e-9, refresh_interval : int = 10) -> Dict[str, tc.Tensor] :
+        """
+        schedules of subjects by Fedorov exchange, a schedule of a subject is exchanged with the best candidate while the loss decreases.
+        Args:
+            subject_size: number of subjects of the design
+            indice: (optional) initial schedule indices of subjects, the result of greedy if it is None.
+            max_iteration: maximum number of sweeps over subjects
+            tolerance_change: minimum decrease of the loss by an exchange
+            refresh_interval: the fisher information matrix of the design is recomputed from the selected schedules
+                after this number of exchanges, instead of accumulating rounding errors of the updates.
+        Returns:
+            indice, schedules, loss and fisher_information_matrix of the design
+        """
+        candidates = self.fisher_information_matrices
+        indice = list(indice) if indice is not None else self.greedy(subject_size)['indice'].tolist()
+
+        fisher_information_matrix = self._fisher_information_matrix(indice)
+        loss_value = None
+        exchange_count = 0
+        for _ in range(max_iteration) :
+            exchanged = False
+            for i in range(len(indice)) :
+                fisher_information_matrix_without = fisher_information_matrix - candidates[indice[i]]
+                losses = self._losses(fisher_information_matrix_without)
+                index = int(losses.argmin())
+                refresh = False
+                if losses[index] < losses[indice[i]] - tolerance_change :
+                    indice[i] = index
+                    exchanged = True
+                    exchange_count += 1
+                    refresh = exchange_count % refresh_interval == 0
+                loss_value = losses[indice[i]]
+
+                # 더하고 빼는 갱신의 반올림 오차가 쌓이지 않도록 refresh_interval번 교환할 때마다 선택된 schedule로 다시 계산한다
+                if refresh :
+                    fisher_information_matrix = self._fisher_information_matrix(indice)
+                else :
+                    fisher_information_matrix = fisher_information_matrix_without + candidates[indice[i]]
+            if not exchanged :
+                break
+
+        return self._result(indice, loss_value)
+
+    def _fisher_information_matrix(self, indice : List[int]) -> tc.Tensor :
+        """
+        fisher information matrix of the design of schedule indices with jitter
+        """
+        candidates = self.fisher_information_matrices
+        eye = tc.eye(candidates.size()[-1], device=candidates.device, dtype=candidates.dtype)
+        return eye * self.jitter + candidates[indice].sum(0)
+
+    def _result(self, indice : List[int], loss_value) -> Dict[str, tc.Tensor] :
+        indice_tensor = tc.tensor(indice, device=self.schedules.device)
+        return {'indice': indice_tensor,
+                'schedules': self.schedules[indice_tensor],
+                'loss': loss_value,
+                'fisher_information_matrix': self.fisher_information_matrices[indice_tensor].sum(0)}
@@ -1,3 +1,4 @@
+from typing import Tuple
 import torch as tc
 import abc
 from .misc import *
@@ -7,6 +8,21 @@ class ObjectiveFunction(metaclass=abc.ABCMeta) :
     def __call__(self, y_true, y_pred, g, h, eta, omega, sigma) -> tc.Tensor:
         pass
 
+    def batch(self, y_true, y_pred, g, h, eta, omega, sigma, mdv_mask) -> Tuple[tc.Tensor, tc.Tensor]:
+        """
+        objective function of padded subjects, the records out of mdv_mask are ignored.
+        Args:
+            y_true, y_pred, mdv_mask: [subjects, max records]
+            g: [subjects, max records, etas]
+            h: [subjects, max records, epss]
+            eta: [subjects, etas]
+        Returns:
+            losses of subjects sized [subjects] and the total loss
+        """
+        losses = tc.stack([self(y_true[i][mask], y_pred[i][mask], g[i][mask], h[i][mask], eta[i], omega, sigma)
+                            for i, mask in enumerate(mdv_mask)])
+        return losses, losses.sum()
+
 class FOCEInterObjectiveFunction(ObjectiveFunction) :
     def __call__(self, y_true, y_pred, g, h, eta, omega, sigma) -> tc.Tensor:
 
@@ -31,60 +47,82 @@ class FOCEInterObjectiveFunction(ObjectiveFunction) :
 
         return tc.squeeze(term1 + term2 + term3 + term4 + term5)
 
+    def batch(self, y_true, y_pred, g, h, eta, omega, sigma, mdv_mask) -> Tuple[tc.Tensor, tc.Tensor]:
+        # v는 대각 행렬이므로 벡터로 다루고, 관측이 아닌 기록은 v = 1, res = 0 으로 두어 loss에 더해지지 않게 한다
+        res = tc.where(mdv_mask, y_true - y_pred, tc.zeros_like(y_pred))
+        v = tc.where(mdv_mask, ((h @ sigma) * h).sum(-1), tc.ones_like(y_pred))
+
+        term1 = v.log().sum(-1)
+        term2 = (res.square() / v).sum(-1)
+
+        eta_size = eta.size()[-1]
+        if eta_size > 0 :
+            # omega의 cholesky factor와 logdet은 모든 subject가 공유한다
+            omega = omega + tc.eye(eta_size, device=omega.device) * 1e-6
+            l_omega = tc.linalg.cholesky(omega)
+            inv_omega = tc.cholesky_inverse(l_omega)
+            term3 = tc.linalg.solve_triangular(l_omega, eta.unsqueeze(-1), upper=False).square().sum((-1, -2))
+            term4 = cholesky_logdet(l_omega)
+            g = g * mdv_mask.unsqueeze(-1)
+            term5 = cholesky_logdet(tc.linalg.cholesky(inv_omega + g.transpose(-1, -2) @ (g / v.unsqueeze(-1))))
+        else :
+            term3 = 0
+            term4 = 0
+            term5 = 0
+
+        losses = term1 + term2 + term3 + term4 + term5
+        return losses, losses.sum()
+
 class FOCEObjectiveFunction(ObjectiveFunction) :
     def __call__(self, y_true, y_pred, g, h, eta, omega, sigma) :
-        v = (h @ sigma @ h.t()).diag().diag()
-        res = y_true - y_pred 
-        c = g @ omega @ g.t() + v
-        r = mat_sqrt_inv(c) @ (res + g @ eta)
-        c_sign, c_det_value = c.slogdet()
-        return tc.squeeze(c_det_value + r.t() @ r)
+        r, c_det_value = whitened_residuals(y_true, y_pred, g, h, eta, omega, sigma)
+        return tc.squeeze(c_det_value + r @ r)
+
+    def batch(self, y_true, y_pred, g, h, eta, omega, sigma, mdv_mask) -> Tuple[tc.Tensor, tc.Tensor]:
+        # cholesky factor 하나로 log det(C)와 whitening을 함께 구한다
+        r, c_det_value = whitened_residuals(y_true, y_pred, g, h, eta, omega, sigma, mdv_mask)
+        losses = c_det_value + r.square().sum(-1)
+        return losses, losses.sum()
     
 
 class DesignOptimalFunction(metaclass = abc.ABCMeta) :
+    """
+    criteria of fisher information matrices sized [..., parameters, parameters],
+    a criterion of each matrix is computed from its cholesky factor.
+    a matrix which is not numerically positive definite is factorized with jitter by jittered_cholesky.
+    """
     @abc.abstractmethod
     def __call__(self, fisher_information_matrix : tc.Tensor) -> tc.Tensor:
         pass
 
 class DOptimality(DesignOptimalFunction) :
     def __call__(self, fisher_information_matrix : tc.Tensor) -> tc.Tensor:
-        # mat = fisher_information_matrix.t() @ fisher_information_matrix
-        mat = fisher_information_matrix
-        i_mat = tc.eye(mat.size()[0], device=mat.device) * 1e-6
-        # mat = mat + i_mat
-        mat = mat.inverse()
-        _, r = tc.linalg.slogdet(mat)
-
-        return r
-        # return -fisher_information_matrix.det().log()
+        # log det(F^-1) = -log det(F)
+        return -cholesky_logdet(jittered_cholesky(fisher_information_matrix))
 
 class AOptimality(DesignOptimalFunction) :
     def __call__(self, fisher_information_matrix : tc.Tensor) -> tc.Tensor:
-        mat = fisher_information_matrix.t() @ fisher_information_matrix
-        # mat = fisher_information_matrix
-        i_mat = tc.eye(mat.size()[0], device=mat.device) * 1e-6
-        # i_mat = ((tc.ones_like(mat.diag()) * (mat.diag() <= 0)) * 1e-3).diag()
-        
-        mat = mat + i_mat
-        mat = mat.inverse()
-        # i_mat = ((tc.ones_like(mat.diag()) * (mat.diag() <= 0)) * 1e-3).diag()
-        # mat = mat + i_mat
-        mat = mat.trace()
-        return mat.log()
+        # tr(F^-1) = ||L^-1||_F^2, F = L L^T
+        l = jittered_cholesky(fisher_information_matrix)
+        eye = tc.eye(l.size()[-1], device=l.device, dtype=l.dtype).expand_as(l)
+        l_inv = tc.linalg.solve_triangular(l, eye, upper=False)
+        return l_inv.square().sum((-1, -2)).log()
 
 class DSOptimality(DesignOptimalFunction) :
 
     '''
         fisher_information_matrix : 
         fisher_information_matrix_ns : No inclusion interesting parameters S
+        returns log of det(fisher_information_matrix) / det(fisher_information_matrix_ns)
     '''
     def __call__(self, fisher_information_matrix : tc.Tensor, fisher_information_matrix_ns) -> tc.Tensor:
-        return tc.linalg.det(fisher_information_matrix) / tc.linalg.det(fisher_information_matrix_ns)
+        return cholesky_logdet(jittered_cholesky(fisher_information_matrix)) \
+                - cholesky_logdet(jittered_cholesky(fisher_information_matrix_ns))
 
 class DEffectivenessOptimality(DesignOptimalFunction) :
     def __call__(self, fisher_information_matrix : tc.Tensor, 
                 fisher_information_matrix_reference : tc.Tensor,
                 num_of_parameters) -> tc.Tensor:
-        r = -tc.linalg.det(fisher_information_matrix) / tc.linalg.det(fisher_information_matrix_reference)
-        return tc.pow(r, 1/num_of_parameters)
-
+        log_r = cholesky_logdet(jittered_cholesky(fisher_information_matrix)) \
+                - cholesky_logdet(jittered_cholesky(fisher_information_matrix_reference))
+        return -(log_r / num_of_parameters).exp()
@@ -1,3 +1,4 @@
+from typing import Dict, List
 import torch as tc
 
 def mat_sqrt_inv(mat) :
@@ -6,6 +7,84 @@ def mat_sqrt_inv(mat) :
     d2 = d.rsqrt()
     return ei_vectors @ d2.diag() @ ei_vectors.t()
 
+def jacobian(outputs, inputs, create_graph : bool = True) :
+    """
+    jacobian of 1-D outputs with respect to each of inputs by one batched backward pass
+    Args:
+        outputs: 1-D tensor
+        inputs: tensors which outputs depend on
+        create_graph: keep the graph of the jacobian for higher order derivatives
+    Returns:
+        jacobians: list of tensors sized [outputs length, *input size], zeros for unused input
+    """
+    output_length = outputs.size()[0]
+    if output_length == 0 :
+        return [tc.zeros(0, *input.size(), device=outputs.device) for input in inputs]
+
+    grad_outputs = tc.eye(output_length, device=outputs.device, dtype=outputs.dtype)
+    jacobians = tc.autograd.grad(outputs,
+                                inputs,
+                                grad_outputs=grad_outputs,
+                                is_grads_batched=True,
+                                create_graph=create_graph,
+                                retain_graph=True,
+                                allow_unused=True)
+    return [jac if jac is not None else tc.zeros(output_length, *input.size(), device=outputs.device)
+                for jac, input in zip(jacobians, inputs)]
+
+def diagonal_jacobian(outputs, inputs, create_graph : bool = True) :
+    """
+    diagonal of jacobian of 1-D outputs with respect to each of inputs by one backward pass,
+    it is valid only if outputs[i] depends on inputs[k][i] alone.
+    Args:
+        outputs: 1-D tensor
+        inputs: tensors sized like outputs
+        create_graph: keep the graph of the jacobian for higher order derivatives
+    Returns:
+        diagonals: list of tensors sized like outputs, zeros for unused input
+    """
+    diagonals = tc.autograd.grad(outputs.sum(),
+                                inputs,
+                                create_graph=create_graph,
+                                retain_graph=True,
+                                allow_unused=True)
+    return [diagonal if diagonal is not None else tc.zeros_like(outputs)
+                for diagonal in diagonals]
+
+def jvp(outputs, inputs, tangents, create_graph : bool = True) :
+    """
+    jacobian-vector products of outputs along several tangents of inputs by two backward passes
+    Args:
+        outputs: tensor
+        inputs: tensors which outputs depend on, and require grad
+        tangents: tangents of each of inputs sized [tangents, *input size]
+        create_graph: keep the graph of the products for higher order derivatives
+    Returns:
+        products: tensor sized [tangents, *outputs size]
+    """
+    tangent_size = tangents[0].size()[0]
+
+    # vector-jacobian product is linear in grad_outputs, its derivative along a tangent is the jacobian-vector product
+    grad_outputs = tc.zeros_like(outputs, requires_grad=True)
+    vjps = tc.autograd.grad(outputs,
+                            inputs,
+                            grad_outputs=grad_outputs,
+                            create_graph=True,
+                            retain_graph=True,
+                            allow_unused=True)
+    used = [(vjp, tangent) for vjp, tangent in zip(vjps, tangents) if vjp is not None and vjp.requires_grad]
+    if len(used) == 0 :
+        return tc.zeros(tangent_size, *outputs.size(), device=outputs.device, dtype=outputs.dtype)
+
+    products = tc.autograd.grad([vjp for vjp, _ in used],
+                                grad_outputs,
+                                grad_outputs=[tangent for _, tangent in used],
+                                is_grads_batched=True,
+                                create_graph=create_graph,
+                                retain_graph=True,
+                                allow_unused=True)[0]
+    return products if products is not None else tc.zeros(tangent_size, *outputs.size(), device=outputs.device, dtype=outputs.dtype)
+
 def lower_triangular_vector_to_covariance_matrix(lower_triangular_vector, diag : bool = True) :
     if diag :
         return lower_triangular_vector.diag()
@@ -21,14 +100,120 @@ def matrix_to_lower_triangular_vector(m : tc.Tensor):
     tril_indices = m.tril().nonzero().t()
     return m[tril_indices[0], tril_indices[1]]
 
-def cwres(y_true, y_pred, g, h, eta, omega, sigma) :    
+def whitened_residuals(y_true, y_pred, g, h, eta, omega, sigma, mdv_mask = None) :
+    """
+    residuals of FOCE whitened by the cholesky factor of C = g omega g^T + V, batched over leading dimensions
+    Args:
+        y_true, y_pred: [..., records]
+        g: [..., records, etas]
+        h: [..., records, epss]
+        eta: [..., etas]
+        mdv_mask: (optional) mask of the records of padded subjects sized [..., records],
+            the others are excluded from C and their residuals are zero.
+    Returns:
+        r: L^-1 (y_true - y_pred + g eta) sized [..., records], C = L L^T
+        logdet: log det(C) sized [...]
+    """
+    res = y_true - y_pred
+    c = ((h @ sigma) * h).sum(-1).diag_embed()
     if eta.size()[-1] > 0:
-        term1 = g @ omega @ g.t()
-        term2 =  g @ eta
-    else : term1, term2 = (0,0)
+        c = c + g @ omega @ g.transpose(-1, -2)
+        res = res + (g @ eta.unsqueeze(-1)).squeeze(-1)
+
+    if mdv_mask is not None :
+        record_pair_mask = mdv_mask.unsqueeze(-1) & mdv_mask.unsqueeze(-2)
+        c = tc.where(record_pair_mask, c, tc.zeros_like(c)) + (~mdv_mask).to(c.dtype).diag_embed()
+        res = tc.where(mdv_mask, res, tc.zeros_like(res))
+
+    l = tc.linalg.cholesky(c)
+    r = tc.linalg.solve_triangular(l, res.unsqueeze(-1), upper=False).squeeze(-1)
+    return r, cholesky_logdet(l)
+
+def cwres(y_true, y_pred, g, h, eta, omega, sigma) :    
+    r, _ = whitened_residuals(y_true, y_pred, g, h, eta, omega, sigma)
+    return r
+
+def cwres_batch(y_true, y_pred, g, h, eta, omega, sigma, mdv_mask) :
+    """
+    cwres of padded subjects sized [subjects, max records], zeros out of mdv_mask
+    """
+    r, _ = whitened_residuals(y_true, y_pred, g, h, eta, omega, sigma, mdv_mask)
+    return r
+
+def bucket_by_length(lengths : List[int]) -> List[List[int]] :
+    """
+    indices of lengths grouped by the power of two not less than each length,
+    padding in a group is less than the length of its longest one.
+    """
+    buckets : Dict[int, List[int]] = {}
+    for i, length in enumerate(lengths) :
+        buckets.setdefault(1 << max(length - 1, 0).bit_length(), []).append(i)
+    return [buckets[key] for key in sorted(buckets)]
+
+def cholesky_logdet(l) :
+    """
+    log determinants of matrices from their cholesky factors sized [..., n, n]
+    """
+    return 2 * l.diagonal(0, -2, -1).log().sum(-1)
+
+def jittered_cholesky(matrix, jitter : float = 1e-6, max_tries : int = 6) :
+    """
+    cholesky factors of symmetric matrices sized [..., n, n],
+    jitter scaled by the mean of the diagonal is added to the matrices which are not numerically positive definite,
+    it is increased tenfold until their factorization succeeds.
+    Args:
+        jitter: initial jitter relative to the mean of the diagonal
+        max_tries: maximum number of increases of jitter, then cholesky raises the error.
+    """
+    l, info = tc.linalg.cholesky_ex(matrix)
+    if not bool((info > 0).any()) :
+        return l
+
+    eye = tc.eye(matrix.size()[-1], device=matrix.device, dtype=matrix.dtype)
+    scale = matrix.detach().diagonal(0, -2, -1).abs().mean(-1).clamp(min=tc.finfo(matrix.dtype).tiny)
+    jitters = tc.zeros_like(scale)
+    for i in range(max_tries) :
+        # 분해에 실패한 행렬에만 jitter를 더하고, 마지막 분해 한 번에서 미분한다
+        jitters = tc.where(info > 0, scale * jitter * 10 ** i, jitters)
+        l, info = tc.linalg.cholesky_ex(matrix + eye * jitters[..., None, None])
+        if not bool((info > 0).any()) :
+            return l
+    return tc.linalg.cholesky(matrix + eye * jitters[..., None, None])
+
+def fisher_information_matrix_by_linearization(gr_theta, h, omega, sigma, jitter : float = 1e-6) :
+    """
+    fisher information matrices of subjects by first order linearization, batched over leading dimensions
+    Args:
+        gr_theta: derivatives of observed predictions with respect to thetas sized [..., records, thetas]
+        h: derivatives of observed predictions with respect to epss sized [..., records, epss]
+        omega: covariance of etas sized [thetas, thetas]
+        sigma: covariance of epss sized [epss, epss]
+        jitter: added to the diagonal of the variance for numerical stability
+    Returns:
+        fisher information matrices sized [..., 2 * thetas + 1, 2 * thetas + 1]
+    """
+    record_size = gr_theta.size()[-2]
+    eye = tc.eye(record_size, device=gr_theta.device, dtype=gr_theta.dtype)
+
+    v = gr_theta @ omega @ gr_theta.transpose(-1, -2) \
+            + ((h @ sigma) * h).sum(-1).diag_embed() \
+            + eye * jitter
+    l = tc.linalg.cholesky(v)
+
+    # v_inv @ gr_theta, v_inv 를 역행렬 없이 cholesky factor로 구한다
+    v_inv_gr_theta = tc.cholesky_solve(gr_theta, l)
+    v_inv = tc.cholesky_solve(eye.expand_as(v), l)
+
+    a_matrix = gr_theta.transpose(-1, -2) @ v_inv_gr_theta
+    c_vector = v_inv_gr_theta.square().sum(-2).unsqueeze(-2)
+    d_scalar = v_inv.square().sum((-1, -2)).unsqueeze(-1).unsqueeze(-1)
+
+    b_matrix = tc.cat([tc.cat([a_matrix * a_matrix, c_vector], dim=-2),
+                       tc.cat([c_vector.transpose(-1, -2), d_scalar], dim=-2)], dim=-1)
 
-    c = term1 + (h @ sigma @ h.t()).diag().diag()
-    return mat_sqrt_inv(c) @ (y_true - y_pred + term2)
+    zeros = tc.zeros(*a_matrix.size()[:-1], b_matrix.size()[-1], device=gr_theta.device, dtype=gr_theta.dtype)
+    return tc.cat([tc.cat([a_matrix, zeros], dim=-1),
+                   tc.cat([zeros.transpose(-1, -2), b_matrix / 2], dim=-1)], dim=-2)
 
 def covariance_to_correlation(m):
     d = m.diag().sqrt()
@@ -1,5 +1,5 @@
 import time
-from typing import Callable, List, Dict, Optional
+from typing import Callable, List, Dict, Optional, Tuple
 import typing
 import torch as tc
 import torch.distributed as dist
@@ -59,10 +59,10 @@ class FOCEInter(tc.nn.Module) :
                 unfixed_parameter_values.append(p.parameter_value)
             
         for k, p in self.pred_function.get_etas().items() :
-            unfixed_parameter_values.extend(list(p.parameter_values.values()))
+            unfixed_parameter_values.append(p.parameter_values)
         
         for k, p in self.pred_function.get_epss().items() :
-            unfixed_parameter_values.extend(list(p.parameter_values.values()))
+            unfixed_parameter_values.append(p.parameter_values)
         
         return unfixed_parameter_values
 
@@ -82,7 +82,14 @@ class FOCEInter(tc.nn.Module) :
         for eps_name in self.eps_names:
             eps.append(epss[eps_name]())
 
-        y_pred, g, h = self._partial_differentiate(pred_output['y_pred'], eta, eps, by_etas = partial_differentiate_by_etas, by_epss = partial_differentiate_by_epss)
+        # forward sensitivity equations에서 얻은 g가 있으면 미분하지 않는다
+        sensitivities = pred_output.get('y_pred_sensitivities')
+        by_sensitivities = partial_differentiate_by_etas and sensitivities is not None and len(eta) > 0
+
+        y_pred, g, h = self._partial_differentiate(pred_output['y_pred'], eta, eps, by_etas = partial_differentiate_by_etas and not by_sensitivities, by_epss = partial_differentiate_by_epss)
+
+        if by_sensitivities :
+            g = tc.stack([sensitivities[eta_name] for eta_name in self.eta_names], dim=-1)
 
         eta = tc.stack(eta)
         eps = tc.stack(eps)
@@ -94,21 +101,86 @@ class FOCEInter(tc.nn.Module) :
         eps_size = len(eps)
 
         if by_epss:
-            h = tc.zeros(y_pred.size()[0], eps_size, device = y_pred.device)
-            for i_h, y_pred_elem in enumerate(y_pred) :
-                if eps_size > 0 :
-                    for i_eps, cur_eps in enumerate(eps):
-                        h_elem = tc.autograd.grad(y_pred_elem, cur_eps, create_graph=True, allow_unused=True, retain_graph=True)
-                        h[i_h,i_eps] = h_elem[0][i_h]
+            if eps_size > 0 and self.pred_function.per_record_eps :
+                h = tc.stack(diagonal_jacobian(y_pred, eps), dim=-1)
+            elif eps_size > 0 :
+                h_jacobians = jacobian(y_pred, eps)
+                h = tc.stack([h_jac.diagonal() for h_jac in h_jacobians], dim=-1)
+            else :
+                h = tc.zeros(y_pred.size()[0], 0, device = y_pred.device)
         else : h = None
 
         if by_etas:
-            g = tc.zeros(y_pred.size()[0], eta_size, device = y_pred.device)
-            for i_g, y_pred_elem in enumerate(y_pred) :
-                if eta_size > 0 :
-                    for i_eta, cur_eta in enumerate(eta) :
-                        g_elem = tc.autograd.grad(y_pred_elem, cur_eta, create_graph=True, allow_unused=True, retain_graph=True)
-                        g[i_g, i_eta] = g_elem[0]
+            if eta_size > 0 :
+                g_jacobians = jacobian(y_pred, eta)
+                g = tc.stack(g_jacobians, dim=-1)
+            else :
+                g = tc.zeros(y_pred.size()[0], 0, device = y_pred.device)
+        else : g = None
+        
+        return y_pred, g, h
+
+    def forward_batch(self, dataset, partial_differentiate_by_etas = True, partial_differentiate_by_epss = True) :
+        """
+        batched forward of subjects
+        Args:
+            dataset: padded records of subjects sized [subjects, max records, columns]
+        Returns:
+            y_pred, mdv_mask : [subjects, max records]
+            eta : [subjects, etas]
+            eps, h : [subjects, max records, epss]
+            g : [subjects, max records, etas], from y_pred_sensitivities of pred_function if it returns them
+        """
+        pred_output = self.pred_function.forward_batch(dataset)
+
+        etas = pred_output['etas']
+        eta = []
+        for eta_name in self.eta_names:
+            eta.append(etas[eta_name]())
+
+        epss = pred_output['epss']
+        eps = []
+        for eps_name in self.eps_names:
+            eps.append(epss[eps_name]())
+
+        sensitivities = pred_output.get('y_pred_sensitivities')
+        by_sensitivities = partial_differentiate_by_etas and sensitivities is not None and len(eta) > 0
+
+        y_pred, g, h = self._partial_differentiate_batch(pred_output['y_pred'], eta, eps, by_etas = partial_differentiate_by_etas and not by_sensitivities, by_epss = partial_differentiate_by_epss)
+
+        if by_sensitivities :
+            g = tc.stack([sensitivities[eta_name] for eta_name in self.eta_names], dim=-1)
+
+        subject_size, max_record_length = y_pred.size()
+        eta = tc.stack(eta, dim=-1) if len(eta) > 0 else tc.zeros(subject_size, 0, device = dataset.device)
+        eps = tc.stack(eps, dim=-1).transpose(0, 1) if len(eps) > 0 else tc.zeros(subject_size, max_record_length, 0, device = dataset.device)
+
+        return y_pred, eta, eps, g, h, self.omega().to(dataset.device), self.sigma().to(dataset.device), pred_output['mdv_mask'], pred_output['output_columns']
+
+    def _partial_differentiate_batch(self, y_pred, eta, eps, by_etas, by_epss) :
+        eta_size = len(eta)
+        eps_size = len(eps)
+        subject_size, max_record_length = y_pred.size()
+
+        # subject끼리는 독립이므로 subject 방향으로 더해서 미분
+        y_pred_sum = y_pred.sum(0)
+
+        if by_epss:
+            if eps_size > 0 and self.pred_function.per_record_eps :
+                h = tc.stack(diagonal_jacobian(y_pred.t(), eps), dim=-1).transpose(0, 1)
+            elif eps_size > 0 :
+                h_jacobians = jacobian(y_pred_sum, eps)
+                h = tc.stack([h_jac.diagonal(0, 0, 1) for h_jac in h_jacobians], dim=-1)
+            else :
+                h = tc.zeros(subject_size, max_record_length, 0, device = y_pred.device)
+        else : h = None
+
+        if by_etas:
+            if eta_size > 0 :
+                g_jacobians = jacobian(y_pred_sum, eta)
+                g = tc.stack(g_jacobians, dim=-1).transpose(0, 1)
+            else :
+                g = tc.zeros(subject_size, max_record_length, 0, device = y_pred.device)
         else : g = None
         
         return y_pred, g, h
@@ -153,6 +225,32 @@ class FOCEInter(tc.nn.Module) :
             return total_loss
         return fit
     
+    def optimization_function_closure_batch(self, dataset, optimizer, checkpoint_file_path : Optional[str] = None) -> Callable:
+        """
+        optimization function for L-BFGS by batched forward of whole subjects
+        Args:
+            dataset: model dataset which is padded
+            optimizer: L-BFGS optimizer
+            checkpoint_file_path : saving for optimized parameters
+        """
+        start_time = time.time()
+
+        def fit() :
+            optimizer.zero_grad()
+
+            y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = self.forward_batch(dataset.padded_dataset)
+
+            losses, total_loss = self.objective_function.batch(dataset.padded_y_true, y_pred, g, h, eta, omega, sigma, mdv_mask)
+            
+            total_loss.backward()
+            
+            if checkpoint_file_path is not None :
+                tc.save(self.state_dict(), checkpoint_file_path)
+        
+            print('running_time : ', time.time() - start_time, '\t total_loss:', total_loss)
+            return total_loss
+        return fit
+    
     def optimization_function_closure_FIM(self, dataset, optimizer, checkpoint_file_path : Optional[str] = None) -> Callable:
         """
         optimization function for L-BFGS 
@@ -163,65 +261,13 @@ class FOCEInter(tc.nn.Module) :
         """
         start_time = time.time()
 
-        dataloader = tc.utils.data.DataLoader(dataset, batch_size=None, shuffle=False, num_workers=0)  # type: ignore
-
         def fit() :
             optimizer.zero_grad()
             
             theta_dict = self.pred_function.get_theta_parameter_values()
-            cov_mat_dim =  len(theta_dict)
-            for tensor in self.omega.parameter_values :
-                cov_mat_dim += tensor.size()[0]
-            for tensor in self.sigma.parameter_values :
-                cov_mat_dim += tensor.size()[0]
-            
             thetas = [theta_dict[key] for key in self.theta_names]
 
-            fisher_information_matrix_total = tc.zeros(cov_mat_dim, cov_mat_dim, device = dataset.device)
-            for data, y_true in dataloader:
-
-                y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = self(data, partial_differentiate_by_etas = False, partial_differentiate_by_epss = True)
- 
-                y_pred_masked = y_pred.masked_select(mdv_mask)
-                
-                eps_size = h.size()[-1]
-                if eps_size > 0:
-                    h = h.t().masked_select(mdv_mask).reshape((eps_size,-1)).t()
- 
-                # y_true_masked = y_true.masked_select(mdv_mask)
-                # minus_2_loglikelihood = self.objective_function(y_true_masked, y_pred, g, h, eta, omega, sigma)
-                
-                gr_theta = []
-                for y_elem in y_pred_masked:
-                    gr_theta_elem = tc.autograd.grad(y_elem, thetas, create_graph=True, allow_unused=True, retain_graph=True)
-                    gr_theta.append(tc.stack(gr_theta_elem))
-                gr_theta = [grad.unsqueeze(0) if grad.dim() == 0 else grad for grad in gr_theta]
-                gr_theta = tc.stack(gr_theta, dim=0)
-
-                #TODO sigma 개선?
-                v = gr_theta @ omega @ gr_theta.t() + (h @ sigma @ h.t()).diag().diag()
-                # v = gr_theta @ omega @ gr_theta.t() +  tc.eye(gr_theta.size()[0], device = dataset.device) * (sigma)
-                v = v + tc.eye(v.size()[0], device = dataset.device) * 1e-6
-                v_inv = v.inverse()
-
-                a_matrix = gr_theta.t() @ v_inv @ gr_theta
-                b_matrix = a_matrix * a_matrix
-                v_sqaure_inv = v_inv @ v_inv
-                c_vector = []
-                for i in range(gr_theta.size()[-1]):
-                    c_vector.append(gr_theta[:,i].t() @ v_sqaure_inv @ gr_theta[:,i])
-                c_vector = tc.stack(c_vector, dim=0).unsqueeze(0)
-
-                b_matrix = tc.cat([b_matrix, c_vector])
-
-                d_scalar = tc.trace(v_sqaure_inv).unsqueeze(0).unsqueeze(0)
-
-                b_matrix = tc.cat([b_matrix, tc.cat([c_vector, d_scalar], dim=1).t()], dim=1)
-
-                fisher_information_matrix = tc.block_diag(a_matrix, b_matrix/2)
-
-                fisher_information_matrix_total = fisher_information_matrix_total + fisher_information_matrix
-            
+            fisher_information_matrix_total = self._fisher_information_matrix_total(dataset, thetas)
             
             loss = self.design_optimal_function(fisher_information_matrix_total)
             loss.backward()
@@ -242,62 +288,13 @@ class FOCEInter(tc.nn.Module) :
             checkpoint_file_path : saving for optimized parameters
         """
         start_time = time.time()
-        
-        if self.dataloader is None :
-            self.dataloader = tc.utils.data.DataLoader(self.pred_function.dataset, batch_size=None, shuffle=False, num_workers=0)
 
         optimizer.zero_grad()
         
         theta_dict = self.pred_function.get_theta_parameter_values()
-        cov_mat_dim =  len(theta_dict)
-        for tensor in self.omega.parameter_values :
-            cov_mat_dim += tensor.size()[0]
-        for tensor in self.sigma.parameter_values :
-            cov_mat_dim += tensor.size()[0]
-        
         thetas = [theta_dict[key] for key in self.theta_names]
 
-        fisher_information_matrix_total = tc.zeros(cov_mat_dim, cov_mat_dim, device = self.pred_function.dataset.device)
-        for data, y_true in self.dataloader:
-
-            y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = self(data, partial_differentiate_by_etas = False, partial_differentiate_by_epss = True)
-
-            y_pred_masked = y_pred.masked_select(mdv_mask)
-
-            eps_size = h.size()[-1]
-            if eps_size > 0:
-                h = h.t().masked_select(mdv_mask).reshape((eps_size,-1)).t()
-            
-            gr_theta = []
-            for y_elem in y_pred_masked:
-                gr_theta_elem = tc.autograd.grad(y_elem, thetas, create_graph=True, allow_unused=True, retain_graph=True)
-                gr_theta.append(tc.stack(gr_theta_elem))
-            gr_theta = [grad.unsqueeze(0) if grad.dim() == 0 else grad for grad in gr_theta]
-            gr_theta = tc.stack(gr_theta, dim=0)
-
-            #TODO sigma 개선
-            v = gr_theta @ omega @ gr_theta.t() + (h @ sigma @ h.t()).diag().diag()
-            v = v + tc.eye(v.size()[0], device = v.device) * 1e-6
-            v_inv = v.inverse()
-
-            a_matrix = gr_theta.t() @ v_inv @ gr_theta
-            b_matrix = a_matrix * a_matrix
-            v_sqaure_inv = v_inv @ v_inv
-            c_vector = []
-            for i in range(gr_theta.size()[-1]):
-                c_vector.append(gr_theta[:,i].t() @ v_sqaure_inv @ gr_theta[:,i])
-            c_vector = tc.stack(c_vector, dim=0).unsqueeze(0)
-
-            b_matrix = tc.cat([b_matrix, c_vector])
-
-            d_scalar = tc.trace(v_sqaure_inv).unsqueeze(0).unsqueeze(0)
-
-            b_matrix = tc.cat([b_matrix, tc.cat([c_vector, d_scalar], dim=1).t()], dim=1)
-
-            fisher_information_matrix = tc.block_diag(a_matrix, b_matrix/2)
-
-            fisher_information_matrix_total = fisher_information_matrix_total + fisher_information_matrix
-            
+        fisher_information_matrix_total = self._fisher_information_matrix_total(self.pred_function.dataset, thetas)
             
         loss = self.design_optimal_function(fisher_information_matrix_total)
         loss.backward()
@@ -308,11 +305,68 @@ class FOCEInter(tc.nn.Module) :
         print('running_time : ', time.time() - start_time, '\t total_loss:', loss)
 
         return loss
-        
 
+    def _fisher_information_matrix(self, y_pred, h, mdv_mask, omega, sigma, thetas) :
+        """
+        fisher information matrices of subjects of the same observation records
+        Args:
+            y_pred, mdv_mask: [records] of a subject, or [subjects, records] of subjects whose mdv_masks are the same
+            h: [records, epss] or [subjects, records, epss]
+            thetas: thetas of the fisher information matrix
+        Returns:
+            fisher information matrix of a subject, or fisher information matrices sized [subjects, *matrix size]
+        """
+        mask = mdv_mask if mdv_mask.dim() == 1 else mdv_mask[0]
+        y_pred = y_pred[..., mask]
+        h = h[..., mask, :]
+
+        # theta마다 한 tangent로 모든 관측값의 미분을 구하므로 비용이 subject와 record 수에 비례하지 않는다
+        eye = tc.eye(len(thetas), device=y_pred.device, dtype=y_pred.dtype)
+        tangents = [eye[:, i].reshape(len(thetas), *theta.size()) for i, theta in enumerate(thetas)]
+        gr_theta = jvp(y_pred, thetas, tangents).movedim(0, -1)
+
+        return fisher_information_matrix_by_linearization(gr_theta, h, omega, sigma)
+
+    def fisher_information_matrix_batch(self, dataset) :
+        """
+        fisher information matrices of subjects by batched forward,
+        subjects of the same mdv_mask are computed together.
+        Args:
+            dataset: padded records of subjects sized [subjects, max records, columns]
+        Returns:
+            fisher information matrices sized [subjects, *matrix size]
+        """
+        theta_dict = self.pred_function.get_theta_parameter_values()
+        thetas = [theta_dict[key] for key in self.theta_names]
+
+        y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = self.forward_batch(dataset, partial_differentiate_by_etas = False, partial_differentiate_by_epss = True)
+
+        _, design_index = tc.unique(mdv_mask, dim=0, return_inverse=True)
+        subject_indice = []
+        fisher_information_matrices = []
+        for i in range(int(design_index.max()) + 1) :
+            subject_index = (design_index == i).nonzero().squeeze(1)
+            subject_indice.append(subject_index)
+            fisher_information_matrices.append(self._fisher_information_matrix(y_pred[subject_index], h[subject_index], mdv_mask[subject_index], omega, sigma, thetas))
+        return tc.cat(fisher_information_matrices)[tc.cat(subject_indice).argsort()]
+
+    def _fisher_information_matrix_total(self, dataset, thetas) :
+        """
+        fisher information matrix of all subjects of dataset,
+        subjects of a padded dataset are computed by fisher_information_matrix_batch.
+        """
+        if getattr(dataset, 'padded', False) :
+            return self.fisher_information_matrix_batch(dataset.padded_dataset).sum(0)
+
+        dataloader = tc.utils.data.DataLoader(dataset, batch_size=None, shuffle=False, num_workers=0)  # type: ignore
+
+        fisher_information_matrix_total = 0
+        for data, y_true in dataloader:
+            y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = self(data, partial_differentiate_by_etas = False, partial_differentiate_by_epss = True)
+            fisher_information_matrix_total = fisher_information_matrix_total + self._fisher_information_matrix(y_pred, h, mdv_mask, omega, sigma, thetas)
+        return fisher_information_matrix_total
 
 
-    
     def optimization_function_for_multiprocessing(self, rank, dataset, optimizer, checkpoint_file_path : Optional[str] = None):
         """
         optimization function for L-BFGS multiprocessing
@@ -365,68 +419,21 @@ class FOCEInter(tc.nn.Module) :
     def evaluate_FIM(self) :
         dataloader = tc.utils.data.DataLoader(self.pred_function.dataset, batch_size=None, shuffle=False, num_workers=0)
 
-        
         theta_dict = self.pred_function.get_theta_parameter_values()
-        cov_mat_dim =  len(theta_dict)
-        for tensor in self.omega.parameter_values :
-            cov_mat_dim += tensor.size()[0]
-        for tensor in self.sigma.parameter_values :
-            cov_mat_dim += tensor.size()[0]
-        
         thetas = [theta_dict[key] for key in self.theta_names]
         
         result : Dict[str, Dict[str, Union[tc.Tensor, List[tc.Tensor]]]]= {}
 
-        fisher_information_matrix_total = tc.zeros(cov_mat_dim, cov_mat_dim, device = self.pred_function.dataset.device)
+        fisher_information_matrix_total = 0
         for data, y_true in dataloader:
 
-            y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = self(data)
+            y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = self(data, partial_differentiate_by_etas = False, partial_differentiate_by_epss = True)
 
             id = str(int(data[:,self.pred_function._column_names.index('ID')][0]))
             result[id] = {}
             result_cur_id = result[id]
 
-            y_pred_masked = y_pred.masked_select(mdv_mask)
-            # eta_size = g.size()[-1]
-            # if eta_size > 0 :
-            #     g = g.t().masked_select(mdv_mask).reshape((eta_size,-1)).t()
-            eps_size = h.size()[-1]
-            if eps_size > 0:
-                h = h.t().masked_select(mdv_mask).reshape((eps_size,-1)).t()
-
-            
-            
-            gr_theta = []
-            for y_elem in y_pred_masked:
-                gr_theta_elem = tc.autograd.grad(y_elem, thetas, create_graph=True, allow_unused=True, retain_graph=True)
-                gr_theta.append(tc.stack(gr_theta_elem))
-            gr_theta = [grad.unsqueeze(0) if grad.dim() == 0 else grad for grad in gr_theta]
-            gr_theta = tc.stack(gr_theta, dim=0)
-
-            #TODO sigma 개선
-            v = gr_theta @ omega @ gr_theta.t() + (h @ sigma @ h.t()).diag().diag()
-            v_inv = v.inverse()
-
-            a_matrix = gr_theta.t() @ v_inv @ gr_theta
-            b_matrix = a_matrix * a_matrix
-            v_sqaure_inv = v_inv @ v_inv
-            c_vector = []
-            for i in range(gr_theta.size()[-1]):
-                c_vector.append(gr_theta[:,i].t() @ v_sqaure_inv @ gr_theta[:,i])
-            c_vector = tc.stack(c_vector, dim=0).unsqueeze(0)
-
-            b_matrix = tc.cat([b_matrix, c_vector])
-
-            d_scalar = tc.trace(v_sqaure_inv).unsqueeze(0).unsqueeze(0)
-
-            b_matrix = tc.cat([b_matrix, tc.cat([c_vector, d_scalar], dim=1).t()], dim=1)
-
-            fisher_information_matrix = tc.block_diag(a_matrix, b_matrix/2)
-
-            fisher_information_matrix_total = fisher_information_matrix_total + fisher_information_matrix
-            
-            
-            
+            fisher_information_matrix_total = fisher_information_matrix_total + self._fisher_information_matrix(y_pred, h, mdv_mask, omega, sigma, thetas)
 
             result_cur_id['pred'] = y_pred
             result_cur_id['time'] = data[:,self.pred_function._column_names.index('TIME')]
@@ -450,6 +457,7 @@ class FOCEInter(tc.nn.Module) :
         # self.pred_function_module.reset_epss()
 
         result : Dict[str, Dict[str, Union[tc.Tensor, List[tc.Tensor]]]]= {}
+        masked_records = []
         for data, y_true in dataloader:
             y_pred, eta, eps, g, h, omega, sigma, mdv_mask, parameters = self(data)
             id = str(int(data[:,self.pred_function._column_names.index('ID')][0]))
@@ -468,11 +476,8 @@ class FOCEInter(tc.nn.Module) :
                 h = h.t().masked_select(mdv_mask).reshape((eps_size,-1)).t()
 
             y_true_masked = y_true.masked_select(mdv_mask)
-            loss = self.objective_function(y_true_masked, y_pred_masked, g, h, eta, omega, sigma)
+            masked_records.append((id, y_true_masked, y_pred_masked, g, h, eta))
 
-            result_cur_id['loss'] = loss
-            
-            result_cur_id['cwres'] = cwres(y_true_masked, y_pred_masked, g, h, eta, omega, sigma)
             result_cur_id['pred'] = y_pred
             result_cur_id['time'] = data[:,self.pred_function._column_names.index('TIME')]
             result_cur_id['mdv_mask'] = mdv_mask
@@ -481,6 +486,22 @@ class FOCEInter(tc.nn.Module) :
                 if name not in result_cur_id.keys() :
                     result_cur_id[name] = []
                 result_cur_id[name].append(value)
+
+        # 관측 수가 비슷한 subject끼리 padding 해서 loss와 cwres를 한 번에 구한다
+        for bucket in bucket_by_length([records[1].size()[0] for records in masked_records]) :
+            ids, y_true_masked, y_pred_masked, g, h, eta = zip(*[masked_records[i] for i in bucket])
+            lengths = tc.tensor([y.size()[0] for y in y_true_masked], device = self.pred_function.dataset.device)
+            mdv_mask = tc.arange(int(lengths.max()), device = lengths.device) < lengths.unsqueeze(1)
+
+            y_true_padded, y_pred_padded, g_padded, h_padded = [tc.nn.utils.rnn.pad_sequence(tensors, batch_first=True) for tensors in (y_true_masked, y_pred_masked, g, h)]
+            eta_stacked = tc.stack(eta)
+
+            losses, _ = self.objective_function.batch(y_true_padded, y_pred_padded, g_padded, h_padded, eta_stacked, omega, sigma, mdv_mask)
+            cwres_values = cwres_batch(y_true_padded, y_pred_padded, g_padded, h_padded, eta_stacked, omega, sigma, mdv_mask)
+
+            for i, id in enumerate(ids) :
+                result[id]['loss'] = losses[i]
+                result[id]['cwres'] = cwres_values[i, :lengths[i]]
             
         self.load_state_dict(state, strict=False)
         
@@ -496,25 +517,57 @@ class FOCEInter(tc.nn.Module) :
         parameters = []
 
         for k, p in self.pred_function.get_etas().items() :
-            parameters.append(p)
+            parameters.append(p.parameter_values)
         
         for k, p in self.pred_function.get_epss().items() :
-            parameters.append(p)
+            parameters.append(p.parameter_values)
         
         return parameters
 
-    def fit_population(self, checkpoint_file_path : Optional[str] = None, learning_rate : float= 1, tolerance_grad = 1e-5, tolerance_change = 1e-5, max_iteration = 9999,):
+    def fit_population(self, checkpoint_file_path : Optional[str] = None, learning_rate : float= 1, tolerance_grad = 1e-5, tolerance_change = 1e-5, max_iteration = 9999,
+                        ode_tolerance_schedule : Optional[List[Tuple[float, float, float]]] = None):
+        """
+        population fitting by L-BFGS
+        Args:
+            checkpoint_file_path : saving for optimized parameters
+            ode_tolerance_schedule : (optional) loose stages [(rtol, atol, tolerance_change), ...] of an ODE model.
+                each stage runs L-BFGS with its tolerances until the change of the objective falls below its tolerance_change,
+                then the final stage runs at rtol and atol of the model with tolerance_change.
+        """
         max_iter = max_iteration
-        parameters = self.parameters()
         self.pred_function.reset_epss()
-        optimizer = tc.optim.LBFGS(parameters, 
-                                   max_iter = max_iter, 
-                                   lr = learning_rate, 
-                                   tolerance_grad = tolerance_grad, 
-                                   tolerance_change = tolerance_change,
-                                   line_search_fn = 'strong_wolfe')
-        opt_fn = self.optimization_function_closure(self.pred_function.dataset, optimizer, checkpoint_file_path = checkpoint_file_path)
-        optimizer.step(opt_fn)
+
+        if ode_tolerance_schedule is not None and not isinstance(self.pred_function, predfunction.PredictionFunctionByODE) :
+            raise Exception('ode_tolerance_schedule is only for PredictionFunctionByODE.')
+
+        if ode_tolerance_schedule is None :
+            stages = [(None, None, tolerance_change)]
+        else :
+            model_tolerances = (self.pred_function.rtol, self.pred_function.atol)
+            stages = [*ode_tolerance_schedule, (*model_tolerances, tolerance_change)]
+
+        try :
+            for rtol, atol, stage_tolerance_change in stages :
+                if rtol is not None :
+                    self.pred_function.rtol = rtol
+                    self.pred_function.atol = atol
+
+                # 허용오차가 바뀌면 목적함수도 바뀌므로 L-BFGS의 기록을 새로 시작한다
+                optimizer = tc.optim.LBFGS(self.parameters(), 
+                                        max_iter = max_iter, 
+                                        lr = learning_rate, 
+                                        tolerance_grad = tolerance_grad, 
+                                        tolerance_change = stage_tolerance_change,
+                                        line_search_fn = 'strong_wolfe')
+                if self.pred_function.dataset.padded :
+                    opt_fn = self.optimization_function_closure_batch(self.pred_function.dataset, optimizer, checkpoint_file_path = checkpoint_file_path)
+                else :
+                    opt_fn = self.optimization_function_closure(self.pred_function.dataset, optimizer, checkpoint_file_path = checkpoint_file_path)
+                optimizer.step(opt_fn)
+        finally :
+            # 느슨한 단계에서 중단되어도 evaluate, covariance_step은 모델의 허용오차로 계산된다
+            if ode_tolerance_schedule is not None :
+                self.pred_function.rtol, self.pred_function.atol = model_tolerances
         return self
     
     def fit_individual(self, checkpoint_file_path : Optional[str] = None, learning_rate = 1, tolerance_grad = 1e-7, tolerance_change = 1e-9, max_iteration = 9999,):
@@ -526,7 +579,10 @@ class FOCEInter(tc.nn.Module) :
                                    tolerance_grad = tolerance_grad, 
                                    tolerance_change = tolerance_change,
                                    line_search_fn = 'strong_wolfe')
-        opt_fn = self.optimization_function_closure(self.pred_function.dataset, optimizer, checkpoint_file_path = checkpoint_file_path)
+        if self.pred_function.dataset.padded :
+            opt_fn = self.optimization_function_closure_batch(self.pred_function.dataset, optimizer, checkpoint_file_path = checkpoint_file_path)
+        else :
+            opt_fn = self.optimization_function_closure(self.pred_function.dataset, optimizer, checkpoint_file_path = checkpoint_file_path)
         optimizer.step(opt_fn)
     # TODO learning_rate 0.5
     def fit_population_FIM(self, parameters, checkpoint_file_path : Optional[str] = None, learning_rate : float= 0.6, tolerance_grad = 1e-7, tolerance_change = 1e-9, max_iteration = 9999,):
@@ -559,9 +615,15 @@ class FOCEInter(tc.nn.Module) :
             # scheduler.step()           
         return self
    
-    def covariance_step(self) :
-
-        dataset = self.pred_function.dataset
+    def covariance_step(self, dataset = None, distributed : bool = False) :
+        """
+        Args:
+            dataset: (optional) subjects of R and S matrices, a partition of DataPartitioner in multiprocessing.
+                the whole dataset of the model if it is None.
+            distributed: R and S matrices of the partitions are summed by all_reduce of the process group,
+                every process returns the same result.
+        """
+        dataset = self.pred_function.dataset if dataset is None else dataset
 
         theta_dict = self.pred_function.get_theta_parameter_values()
 
@@ -591,9 +653,6 @@ class FOCEInter(tc.nn.Module) :
         for data, y_true in dataloader:
             
             y_pred, eta, eps, g, h, omega, sigma, mdv_mask, _ = self(data)
-
-            id = str(int(data[:,self.pred_function._column_names.index('ID')][0]))
-            print('id', id)
  
             y_pred = y_pred.masked_select(mdv_mask)
 
@@ -613,13 +672,16 @@ class FOCEInter(tc.nn.Module) :
             with tc.no_grad() :
                 s_mat.add_((gr_cat.detach().unsqueeze(1) @ gr_cat.detach().unsqueeze(0))/4)
             
-            for i, gr_cur in enumerate(gr_cat) :
-                hs = tc.autograd.grad(gr_cur, estimated_parameters, create_graph=True, retain_graph=True, allow_unused=True)
+            # hessian의 모든 행을 한 번의 batched backward로 구한다
+            hessians = jacobian(gr_cat, estimated_parameters, create_graph=False)
+            hessian = tc.cat([hessian.reshape(gr_cat.size()[0], -1) for hessian in hessians], dim=1)
+
+            with tc.no_grad() :
+                r_mat.add_(hessian.detach()/2)
 
-                hs = [grad.unsqueeze(0) if grad.dim() == 0 else grad for grad in hs]
-                hs_cat = tc.cat(hs)
-                for j, hs_elem in enumerate(hs_cat) :
-                    r_mat[i,j] = r_mat[i,j] + hs_elem.detach()/2
+        if distributed :
+            dist.all_reduce(r_mat, op=dist.ReduceOp.SUM)
+            dist.all_reduce(s_mat, op=dist.ReduceOp.SUM)
 
         invR = r_mat.inverse()
         
@@ -666,39 +728,45 @@ class FOCEInter(tc.nn.Module) :
         dataloader = tc.utils.data.DataLoader(dataset, batch_size=None, shuffle=False, num_workers=0)
 
         result : Dict[str, Dict[str, Union[tc.Tensor, List[tc.Tensor]]]] = {}
-        for i, (data, _) in enumerate(dataloader):
+        # dataset 밖의 subject는 scratch subject로 추가되고 끝나면 버려진다
+        with self.pred_function.scratch_subjects() :
+            for i, (data, _) in enumerate(dataloader):
             
-            id = str(int(data[:, self.pred_function._column_names.index('ID')][0]))
+                id = str(int(data[:, self.pred_function._column_names.index('ID')][0]))
             
-            etas_cur = etas[i,:,:]
-            epss_cur = epss[i,:,:]
-
-            time_data = data[:,self.pred_function._column_names.index('TIME')].t()
-
-            result[id] = {}
-            result_cur_id : Dict[str, Union[tc.Tensor, List[tc.Tensor]]] = result[id]
-            result_cur_id['time'] = time_data
-            result_cur_id['etas'] = etas_cur
-            result_cur_id['epss'] = epss_cur
-            result_cur_id['preds'] = []
-            for repeat_iter in range(repeat) :
-
-                with tc.no_grad() :
-                    eta_value = etas_cur[repeat_iter]
-                    eps_value = epss_cur[repeat_iter]
-
-                    for eta_i, name in enumerate(self.eta_names) :
-                        eta_parameter_values[name].update({str(int(id)): tc.nn.Parameter(eta_value[eta_i])})
-
-                    for eps_i, name in enumerate(self.eps_names) :
-                        eps_parameter_values[name].update({str(int(id)): tc.nn.Parameter(eps_value[:data.size()[0],eps_i])})
-
-                    r  = self.pred_function(data)
-                    y_pred = r['y_pred']
-
-                    result_cur_id['preds'].append(y_pred)
-                    for name, value in r['output_columns'].items() :
-                        if name not in result_cur_id.keys() :
-                            result_cur_id[name] = []
-                        result_cur_id[name].append(value)
+                etas_cur = etas[i,:,:]
+                epss_cur = epss[i,:,:]
+
+                time_data = data[:,self.pred_function._column_names.index('TIME')].t()
+
+                result[id] = {}
+                result_cur_id : Dict[str, Union[tc.Tensor, List[tc.Tensor]]] = result[id]
+                result_cur_id['time'] = time_data
+                result_cur_id['etas'] = etas_cur
+                result_cur_id['epss'] = epss_cur
+                result_cur_id['preds'] = []
+                for repeat_iter in range(repeat) :
+
+                    with tc.no_grad() :
+                        eta_value = etas_cur[repeat_iter]
+                        eps_value = epss_cur[repeat_iter]
+
+                        subject_index = self.pred_function._get_subject_index(id, data.size()[0])
+                        eta_modules = self.pred_function.get_etas()
+                        for eta_i, name in enumerate(self.eta_names) :
+                            eta_modules[name].assign(subject_index, eta_value[eta_i])
+
+                        record_slice = self.pred_function._get_record_slice(id)
+                        eps_modules = self.pred_function.get_epss()
+                        for eps_i, name in enumerate(self.eps_names) :
+                            eps_modules[name].assign(record_slice, eps_value[:data.size()[0],eps_i])
+
+                        r  = self.pred_function(data)
+                        y_pred = r['y_pred']
+
+                        result_cur_id['preds'].append(y_pred)
+                        for name, value in r['output_columns'].items() :
+                            if name not in result_cur_id.keys() :
+                                result_cur_id[name] = []
+                            result_cur_id[name].append(value)
         return result
\ No newline at end of file
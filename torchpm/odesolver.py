@@ -1,50 +1,255 @@
 from copy import deepcopy
-from typing import ClassVar, List, Optional, Dict, Iterable, Union
+from typing import Callable, ClassVar, List, Optional, Dict, Iterable, Tuple, Union
+import hashlib
+import importlib.util
+import inspect
+import json
+import linecache
+import os
+import types
 import torch as tc
 import numpy as np
 import sympy as sym
 import sympytorch as spt
+from sympy.printing.pycode import PythonCodePrinter
 from torch import nn
 
+class TorchCodePrinter(PythonCodePrinter) :
+    """
+    printer of sympy expressions to torch code
+    """
+    # 상위 printer의 함수들은 그대로 두고 torch 함수로 바꿀 것만 덮어쓴다
+    _kf = {**PythonCodePrinter._kf,
+           'exp': 'torch.exp', 'log': 'torch.log', 'sqrt': 'torch.sqrt',
+           'sin': 'torch.sin', 'cos': 'torch.cos', 'tan': 'torch.tan',
+           'sinh': 'torch.sinh', 'cosh': 'torch.cosh', 'tanh': 'torch.tanh'}
+
+    def _print_Pow(self, expr, rational=False) :
+        return self._hprint_Pow(expr, rational=rational, sqrt='torch.sqrt')
+
+def generate_source(functions : Dict[str, List[sym.Expr]]) -> str :
+    """
+    python source of torch functions of expressions, common subexpressions of the expressions of a function are computed once.
+    Args:
+        functions: expressions by function names
+    Returns:
+        source: a function of a name takes the symbols of its expressions as arguments,
+            and returns the expressions stacked in the last dimension.
+    """
+    printer = TorchCodePrinter()
+    lines = ['import math', 'import torch', '']
+    for name, expressions in functions.items() :
+        arguments = sorted({symbol.name for expression in expressions for symbol in expression.free_symbols} | {'t'})
+        replacements, reduced_expressions = sym.cse(expressions)
+
+        lines.append('def ' + name + '(' + ', '.join(arguments) + '):')
+        for symbol, value in replacements :
+            lines.append('    ' + str(symbol) + ' = ' + printer.doprint(value))
+        outputs = ', '.join('torch.zeros_like(t) + (' + printer.doprint(expression) + ')' for expression in reduced_expressions)
+        lines.append('    return torch.stack(torch.broadcast_tensors(' + outputs + '), -1)')
+        lines.append('')
+    return '\n'.join(lines)
+
+def load_generated_module(file_path : str, source : Optional[str] = None) :
+    """
+    Args:
+        file_path: file of the generated source
+        source: (optional) generated source which is not saved, file_path is its name for inspect.
+    Returns:
+        module of the generated functions
+    """
+    module_name = 'torchpm_generated_' + os.path.splitext(os.path.basename(file_path))[0]
+    if source is None :
+        spec = importlib.util.spec_from_file_location(module_name, file_path)
+        module = importlib.util.module_from_spec(spec)  # type: ignore
+        spec.loader.exec_module(module)  # type: ignore
+        return module
+    
+    # TorchScript가 inspect로 source를 읽을 수 있도록 linecache에 등록한다
+    linecache.cache[file_path] = (len(source), None, source.splitlines(True), file_path)
+    module = types.ModuleType(module_name)
+    exec(compile(source, file_path, 'exec'), module.__dict__)
+    return module
+
+class GeneratedExpressionModule(nn.Module) :
+    """
+    Args:
+        function: generated function of expressions
+    """
+    def __init__(self, function : Callable) -> None:
+        super().__init__()
+        self.function = function
+        self.argument_names = list(inspect.signature(function).parameters.keys())
+
+    def forward(self, **variables) :
+        return self.function(**{name: variables[name] for name in self.argument_names})
+
+def expand_distribution_matrix(distribution_bool_matrix: List[List[bool]], has_depot : bool, transit : int, administrated_compartment_num : int) -> Tuple[List[List[bool]], int] :
+    """
+    distribution matrix with the depot and transit compartments appended
+    Returns:
+        distribution_bool_matrix: expanded distribution matrix
+        depot_compartment_num: compartment which takes doses
+    """
+    expanded_matrix = deepcopy(distribution_bool_matrix)
+    depot_compartment_num = administrated_compartment_num
+    if has_depot :
+        expanded_matrix.append([False] * len(expanded_matrix))
+        for row in expanded_matrix :
+            row.append(False)
+        expanded_matrix[-1][administrated_compartment_num] = True
+    
+        depot_compartment_num = len(distribution_bool_matrix)
+
+    if has_depot and transit > 0 :
+        expanded_matrix[-1][administrated_compartment_num] = False
+        length = len(expanded_matrix)
+        for row in range(transit) :
+            expanded_matrix.append([False] * length)
+        
+        for row in expanded_matrix :
+            for i in range(transit):
+                row.append(False)
+        
+        #depot to transit 0
+        expanded_matrix[depot_compartment_num][depot_compartment_num+1] = True
+        transit_start = depot_compartment_num + 1 
+        for i in range(transit_start, transit_start + transit - 1):
+            expanded_matrix[i][i+1] = True
+        expanded_matrix[-1][administrated_compartment_num] = True
+    return expanded_matrix, depot_compartment_num
+
+def rate_constant_name(i : int, j : int, compartment_size : int) -> str :
+    """
+    name of the rate constant from compartment i to j, k_ii is the elimination rate of i.
+    indices are separated by '_' if they can have two digits.
+    """
+    if compartment_size <= 10 :
+        return 'k_' + str(i) + str(j)
+    return 'k_' + str(i) + '_' + str(j)
+
+def superpose_doses(amounts_function : Callable, t : tc.Tensor, dose_times : Optional[tc.Tensor], variables : Dict[str, tc.Tensor]) -> tc.Tensor :
+    """
+    Args:
+        amounts_function: amounts of compartments sized [*batch, times, compartments] by times after a dose and variables
+        t: times sized [times] or [*batch, times]
+        dose_times: (optional) times of doses sized [*batch], the last dimension of batch is of doses
+        variables: variables of amounts_function sized [] or [*batch], or [*batch] without doses, python numbers are taken as tensors.
+    Returns:
+        amounts of compartments sized [compartments, *batch, times], summed over doses if dose_times is given
+    """
+    variables = {name: tc.as_tensor(value, device = t.device) for name, value in variables.items()}
+
+    if dose_times is None :
+        return amounts_function(t, variables).movedim(-1, 0)
+
+    # dose 차원이 없는 변수는 모든 dose에 같은 값을 쓴다
+    variables = {name: value.reshape(value.size() + (1,) * (dose_times.dim() - value.dim())) for name, value in variables.items()}
+
+    time_after_dose = t.unsqueeze(-2) - dose_times.unsqueeze(-1)
+    amounts = amounts_function(time_after_dose.clamp(min = 0), variables)
+    amounts = tc.where((time_after_dose >= 0).unsqueeze(-1), amounts, tc.zeros_like(amounts))
+    return amounts.sum(-3).movedim(-1, 0)
+
+def _parse_srepr(text : str) -> sym.Expr :
+    """
+    expression of a srepr string, names other than sympy classes are not allowed unlike sympify.
+    """
+    # srepr에는 dunder가 없으므로 속성을 타고 builtins에 접근하는 문자열을 거부한다
+    if '__' in text :
+        raise ValueError('invalid expression in the cache: ' + text)
+    namespace = {name: value for name, value in vars(sym).items() if isinstance(value, type) and not name.startswith('_')}
+    return sym.parse_expr(text, local_dict=namespace, global_dict={'__builtins__': {}}, transformations=())
+
 class CompartmentModelGenerator(nn.Module) :
-    def __init__(self, distribution_bool_matrix: List[List[bool]], has_depot : bool = False, transit : int = 0, observed_compartment_num = 0, administrated_compartment_num = 0, is_infusion : bool= False) -> None:
+    """
+    Args:
+        cache_directory: (optional) directory of the solved expressions keyed by the topology of the model,
+            a model of a cached topology is built from the cache without solving.
+        codegen: the expressions are evaluated by a generated torch function with common subexpressions eliminated
+            instead of sympytorch, the source is saved to cache_directory and imported from it.
+            the function is compatible with torch.jit.script and torch.compile.
+    Note:
+        cache_directory must be trusted like the source of the model, the generated source in it is imported.
+        the cached expressions are parsed with sympy classes only, and are solved again
+        if they are saved by another cache_format_version or sympy version.
+    """
+
+    cache_format_version : ClassVar[int] = 1
+
+    def __init__(self, distribution_bool_matrix: List[List[bool]], has_depot : bool = False, transit : int = 0, observed_compartment_num = 0, administrated_compartment_num = 0, is_infusion : bool= False, cache_directory : Optional[str] = None, codegen : bool = False) -> None:
         super().__init__()
 
-        self.distribution_bool_matrix = deepcopy(distribution_bool_matrix)
+        topology = [distribution_bool_matrix, has_depot, transit, observed_compartment_num, administrated_compartment_num, is_infusion]
+
         self.is_infusion = is_infusion
         self.obeserved_compartment_num = observed_compartment_num
         self.administrated_compartment_num = administrated_compartment_num
-        self.depot_compartment_num = administrated_compartment_num
-        if has_depot :
-            self.distribution_bool_matrix.append([False] * len(self.distribution_bool_matrix))
-            for row in self.distribution_bool_matrix :
-                row.append(False)
-            self.distribution_bool_matrix[-1][self.administrated_compartment_num] = True
-        
-            self.depot_compartment_num = len(distribution_bool_matrix)
+        self.distribution_bool_matrix, self.depot_compartment_num = expand_distribution_matrix(distribution_bool_matrix, has_depot, transit, administrated_compartment_num)
 
-        if has_depot and transit > 0 :
-            self.distribution_bool_matrix[-1][self.administrated_compartment_num] = False
-            length = len(self.distribution_bool_matrix)
-            for row in range(transit) :
-                self.distribution_bool_matrix.append([False] * length)
-            
-            for row in self.distribution_bool_matrix :
-                for i in range(transit):
-                    row.append(False)
-            
-            #depot to transit 0
-            self.distribution_bool_matrix[self.depot_compartment_num][self.depot_compartment_num+1] = True
-            transit_start = self.depot_compartment_num + 1 
-            for i in range(transit_start, transit_start + transit - 1):
-                self.distribution_bool_matrix[i][i+1] = True
-            self.distribution_bool_matrix[-1][self.administrated_compartment_num] = True
-            
+        cache_file_path = None
+        if cache_directory is not None :
+            # 형식이나 sympy 버전이 다르면 다른 파일을 쓴다
+            key = hashlib.sha256(json.dumps([self.cache_format_version, sym.__version__, topology]).encode()).hexdigest()
+            cache_file_path = os.path.join(cache_directory, key + '.json')
+
+        expressions = None
+        if cache_file_path is not None and os.path.exists(cache_file_path) :
+            expressions = self._load_expressions(cache_file_path)
+
+        if expressions is not None :
+            comps, comps_infusion = expressions
+        else :
+            comps, comps_infusion = self._solve_expressions()
+            if cache_file_path is not None :
+                self._save_expressions(cache_file_path, comps, comps_infusion)
+
+        if codegen :
+            self._init_generated_models(comps, comps_infusion, cache_file_path)
+            return
+
+        if is_infusion :
+            self.infusion_model = spt.SymPyModule(expressions=comps_infusion, extra_funcs={sym.core.numbers.Half: lambda : tc.tensor(1/2)})
+                # sym.core.numbers.Rational: lambda p, q=None: p/q
+
+        #TODO 제거
+        # comps.append(sym.Eq(sym.core.numbers.Half, tc.tensor(1/2), sympify=False))
+        self.model = spt.SymPyModule(expressions=comps, extra_funcs={sym.core.numbers.Half: lambda : tc.tensor(1/2)})
+    
+    def _init_generated_models(self, comps : List[sym.Expr], comps_infusion : Optional[List[sym.Expr]], cache_file_path : Optional[str]) :
+        functions = {'compartment_amounts': comps}
+        if comps_infusion is not None :
+            functions['infusion_compartment_amounts'] = comps_infusion
+
+        if cache_file_path is None :
+            source = generate_source(functions)
+            file_path = '<torchpm-generated-' + hashlib.sha256(source.encode()).hexdigest() + '>'
+            module = load_generated_module(file_path, source)
+        else :
+            file_path = os.path.splitext(cache_file_path)[0] + '.py'
+            if not os.path.exists(file_path) :
+                temporary_file_path = file_path + '.' + str(os.getpid())
+                with open(temporary_file_path, 'w') as file :
+                    file.write(generate_source(functions))
+                os.replace(temporary_file_path, file_path)
+            module = load_generated_module(file_path)
+
+        self.model = GeneratedExpressionModule(module.compartment_amounts)
+        if comps_infusion is not None :
+            self.infusion_model = GeneratedExpressionModule(module.infusion_compartment_amounts)
+
+    def _solve_expressions(self) -> Tuple[List[sym.Expr], Optional[List[sym.Expr]]] :
+        """
+        Returns:
+            comps: amounts of compartments by time
+            comps_infusion: (optional) amounts of compartments by time during the infusion
+        """
         dCdts = self._get_dCdts(is_infusion=False)
         initial_states = self._get_initial_states(is_infusion=False)
         cs = self._solve(dCdts, initial_states)
 
-        if is_infusion :
+        comps_infusion = None
+        if self.is_infusion :
         
             t_sym, dose_sym, r_sym = sym.symbols('t d r', positive = True, real=True, allow_half=False)
             dCdts_infusion = self._get_dCdts(is_infusion=True)
@@ -61,19 +266,42 @@ class CompartmentModelGenerator(nn.Module) :
             comps_infusion = []
             for comp in cs_infusion :
                 comps_infusion.append(comp.rhs)
-            self.infusion_model = spt.SymPyModule(expressions=comps_infusion, extra_funcs={sym.core.numbers.Half: lambda : tc.tensor(1/2)})
-
-            
-                # sym.core.numbers.Rational: lambda p, q=None: p/q
 
         comps = []
         for comp in cs :
             comps.append(comp.rhs)
-        #TODO 제거
-        # comps.append(sym.Eq(sym.core.numbers.Half, tc.tensor(1/2), sympify=False))
-        self.model = spt.SymPyModule(expressions=comps, extra_funcs={sym.core.numbers.Half: lambda : tc.tensor(1/2)})
-    
-    
+        return comps, comps_infusion
+
+    def _save_expressions(self, file_path : str, comps : List[sym.Expr], comps_infusion : Optional[List[sym.Expr]]) :
+        """
+        save expressions by srepr, which keeps the assumptions of the symbols
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        expressions = {'format': self.cache_format_version,
+                       'sympy': sym.__version__,
+                       'comps': [sym.srepr(comp) for comp in comps],
+                       'comps_infusion': None if comps_infusion is None else [sym.srepr(comp) for comp in comps_infusion]}
+        # 병렬로 만드는 다른 프로세스가 쓰다 만 파일을 읽지 않도록 이름을 바꿔서 저장한다
+        temporary_file_path = file_path + '.' + str(os.getpid())
+        with open(temporary_file_path, 'w') as file :
+            json.dump(expressions, file)
+        os.replace(temporary_file_path, file_path)
+
+    def _load_expressions(self, file_path : str) -> Optional[Tuple[List[sym.Expr], Optional[List[sym.Expr]]]] :
+        """
+        load expressions saved by _save_expressions
+        Returns:
+            None if the expressions are saved by another cache_format_version or sympy version
+        """
+        with open(file_path) as file :
+            expressions = json.load(file)
+        if expressions.get('format') != self.cache_format_version or expressions.get('sympy') != sym.__version__ :
+            return None
+
+        comps = [_parse_srepr(comp) for comp in expressions['comps']]
+        comps_infusion = None if expressions['comps_infusion'] is None else [_parse_srepr(comp) for comp in expressions['comps_infusion']]
+        return comps, comps_infusion
+
 
     def _check_square_matrix(self, m : List[List[bool]], error_massage) :
         length = len(m)
@@ -141,23 +369,108 @@ class CompartmentModelGenerator(nn.Module) :
         function = sym.solvers.ode.systems.dsolve_system(dCdts, ics=ics, doit=True)
         return function[0]
 
-    def forward(self, t, **variables):
-        
+    def forward(self, t, dose_times : Optional[tc.Tensor] = None, **variables):
+        """
+        Args:
+            t: times sized [times] or [*batch, times]
+            dose_times: (optional) times of doses sized [*batch], the last dimension of batch is of doses (e.g. [subjects, doses]).
+                if it is given, amounts of the doses are superposed.
+            variables: rate constants, dose d and infusion rate r sized [] or [*batch], or [*batch] without doses
+        Returns:
+            amounts of compartments sized [compartments, *batch, times], without doses of batch if dose_times is given
+        """
+        return superpose_doses(self._amounts, t, dose_times, variables)
+
+    def _amounts(self, t, variables) :
+        """
+        Returns:
+            amounts of compartments sized [*batch, times, compartments]
+        """
+        variables = {name: value.unsqueeze(-1) for name, value in variables.items()}
+
         if self.is_infusion :
             infusion_end_time = variables['d'] / variables['r']
 
-            
-            infusion_t = tc.masked_select(t, t <= infusion_end_time)
-            elimination_t = tc.masked_select(t, t > infusion_end_time)
+            # 두 식을 모든 시간에서 계산하고 고르며, 범위 밖의 시간은 경계로 잘라 exp가 커지지 않게 한다
+            infusion_amt = self.infusion_model(t = tc.minimum(t, infusion_end_time), **variables)
+            amt = self.model(t = tc.maximum(t, infusion_end_time), **variables)
+            return tc.where((t <= infusion_end_time).unsqueeze(-1), infusion_amt, amt)
+        else :
+            return self.model(t = t, **variables)
+
+class NumericCompartmentModel(nn.Module) :
+    """
+    compartment model of the same topology as CompartmentModelGenerator solved numerically by matrix exponentials,
+    it is exact for repeated eigenvalues (e.g. transit compartments of the same rate) and takes any number of compartments.
+    rate constants are named by rate_constant_name, and they can be batched (e.g. [subjects]) with d and r.
+    """
+    def __init__(self, distribution_bool_matrix: List[List[bool]], has_depot : bool = False, transit : int = 0, observed_compartment_num = 0, administrated_compartment_num = 0, is_infusion : bool= False) -> None:
+        super().__init__()
+        self.is_infusion = is_infusion
+        self.obeserved_compartment_num = observed_compartment_num
+        self.administrated_compartment_num = administrated_compartment_num
+        self.distribution_bool_matrix, self.depot_compartment_num = expand_distribution_matrix(distribution_bool_matrix, has_depot, transit, administrated_compartment_num)
+
+    def rate_matrix(self, **variables) -> tc.Tensor :
+        """
+        Returns:
+            rate matrix A of dc/dt = A c sized [*batch, compartments, compartments]
+        """
+        comps_num = len(self.distribution_bool_matrix)
+        names = [rate_constant_name(i, j, comps_num) for i in range(comps_num) for j in range(comps_num) if self.distribution_bool_matrix[i][j]]
+        batch_shape = tc.broadcast_shapes(*[variables[name].size() for name in names])
+        zero = tc.zeros(batch_shape, device = variables[names[0]].device, dtype = variables[names[0]].dtype)
+
+        entries = [[zero] * comps_num for _ in range(comps_num)]
+        for i in range(comps_num) :
+            for j in range(comps_num) :
+                if not self.distribution_bool_matrix[i][j] :
+                    continue
+                k = variables[rate_constant_name(i, j, comps_num)]
+                entries[i][i] = entries[i][i] - k
+                if i != j :
+                    entries[j][i] = entries[j][i] + k
+        return tc.stack([tc.stack(row, -1) for row in entries], -2)
 
-            variables['t'] = infusion_t
-            infusion_amt = self.infusion_model(**variables).t()
+    def forward(self, t, dose_times : Optional[tc.Tensor] = None, **variables) :
+        """
+        Args:
+            t: times sized [times] or [*batch, times]
+            dose_times: (optional) times of doses sized [*batch], the last dimension of batch is of doses (e.g. [subjects, doses]).
+                if it is given, amounts of the doses are superposed.
+            variables: rate constants, dose d and infusion rate r sized [] or [*batch], or [*batch] without doses
+        Returns:
+            amounts of compartments sized [compartments, *batch, times], without doses of batch if dose_times is given
+        """
+        return superpose_doses(self._amounts, t, dose_times, variables)
+
+    def _amounts(self, t, variables) :
+        """
+        Returns:
+            amounts of compartments sized [*batch, times, compartments]
+        """
+        rate_matrix = self.rate_matrix(**variables)
+        comps_num = rate_matrix.size()[-1]
+        dose = variables['d']
+        depot = tc.nn.functional.one_hot(tc.tensor(self.depot_compartment_num), comps_num).to(rate_matrix)
+
+        if self.is_infusion :
+            rate = variables['r']
+            infusion_end_time = (dose / rate).unsqueeze(-1)
 
-            variables['t'] = elimination_t
-            amt = self.model(**variables).t()
+            # [[A, r], [0, 0]]의 matrix exponential의 마지막 열이 infusion 중의 amount이다
+            # dose 차원은 r에만 있을 수 있으므로 rate matrix와 r의 batch를 함께 broadcast한다
+            batch_shape = tc.broadcast_shapes(rate_matrix.size()[:-2], rate.size())
+            rate_matrix = rate_matrix.broadcast_to(*batch_shape, comps_num, comps_num)
+            infusion_column = (rate.unsqueeze(-1) * depot).broadcast_to(*batch_shape, comps_num).unsqueeze(-1)
+            augmented_matrix = tc.cat([rate_matrix, infusion_column], -1)
+            augmented_matrix = tc.cat([augmented_matrix, tc.zeros_like(augmented_matrix[..., :1, :])], -2)
+            infusion_t = tc.minimum(t, infusion_end_time)
+            amounts_infused = tc.linalg.matrix_exp(augmented_matrix.unsqueeze(-3) * infusion_t[..., None, None])[..., :comps_num, comps_num]
 
-            variables['t'] = t
-            return tc.concat([infusion_amt, amt], dim = -1)
+            elimination_t = (t - infusion_end_time).clamp(min = 0)
+            amounts = (tc.linalg.matrix_exp(rate_matrix.unsqueeze(-3) * elimination_t[..., None, None]) @ amounts_infused.unsqueeze(-1)).squeeze(-1)
         else :
-            variables['t'] = t
-            return self.model(**variables).t()
\ No newline at end of file
+            initial_amounts = dose[..., None, None] * depot
+            amounts = (tc.linalg.matrix_exp(rate_matrix.unsqueeze(-3) * t[..., None, None]) @ initial_amounts.unsqueeze(-1)).squeeze(-1)
+        return amounts
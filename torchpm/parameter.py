@@ -110,25 +110,102 @@ class Theta(nn.Module):
 
 
 
+def _index_values(parameter_values : tc.Tensor, scratch_values : Optional[tc.Tensor], index : Union[int, slice, tc.Tensor]) -> tc.Tensor :
+    """
+    values at index of parameter_values followed by scratch_values, they are indexed separately without concatenation.
+    """
+    size = parameter_values.size()[0]
+    if scratch_values is None or scratch_values.size()[0] == 0 :
+        return parameter_values[index]
+    if size == 0 :
+        return scratch_values[index]
+
+    if isinstance(index, int) :
+        return parameter_values[index] if index < size else scratch_values[index - size]
+    if isinstance(index, slice) :
+        return parameter_values[index] if index.start < size else scratch_values[index.start - size : index.stop - size]
+
+    # batch에는 두 저장소의 index가 섞일 수 있으므로 각각에서 골라서 합친다
+    return tc.where(index < size, parameter_values[index.clamp(max = size - 1)], scratch_values[(index - size).clamp(min = 0)])
+
 class Eta(nn.Module) :
 
+    """
+    Attributes:
+        parameter_values: etas of all subjects sized [subjects], a subject index of PredictionFunction points its eta.
+        scratch_values: etas of the subjects added in scratch_subjects of PredictionFunction, indexed after parameter_values.
+    """
+
     def __init__(self) -> None:
         super().__init__()
-        self.parameter_values = nn.ParameterDict()
+        self.parameter_values = nn.Parameter(tc.zeros(0))
+        self.scratch_values : Optional[tc.Tensor] = None
+        self.value : Optional[tc.Tensor] = None
+
+    def assign(self, index : int, value) :
+        """
+        assigns the eta of a subject index, the index of a scratch subject is after parameter_values.
+        """
+        size = self.parameter_values.size()[0]
+        with tc.no_grad() :
+            if index < size :
+                self.parameter_values[index] = value
+            else :
+                self.scratch_values[index - size] = value
+
+    def set_index(self, index : Union[int, tc.Tensor]) :
+        """
+        Args:
+            index: subject index, or subject indices of a batch. etas of them are returned by forward.
+        """
+        self.value = _index_values(self.parameter_values, self.scratch_values, index)
 
     def forward(self):
-        return self.parameter_values[str(self.id)]
+        return self.value
 
 
 
 class Eps(nn.Module):
 
+    """
+    Attributes:
+        parameter_values: epss of all records of all subjects sized [total records],
+            records of a subject are contiguous from its record offset of PredictionFunction.
+        scratch_values: epss of the records of the subjects added in scratch_subjects of PredictionFunction,
+            indexed after parameter_values.
+    """
+
     def __init__(self) -> None:
         super().__init__()
-        self.parameter_values : Dict[str, nn.Parameter] = {}
+        self.register_buffer('parameter_values', tc.zeros(0))
+        self.scratch_values : Optional[tc.Tensor] = None
+        self.value : Optional[tc.Tensor] = None
+
+    def assign(self, index : slice, value) :
+        """
+        assigns the epss of a record slice, the records of a scratch subject are after parameter_values.
+        """
+        size = self.parameter_values.size()[0]
+        with tc.no_grad() :
+            if index.start < size :
+                self.parameter_values[index] = value
+            else :
+                self.scratch_values[index.start - size : index.stop - size] = value
+
+    def set_index(self, index : Union[slice, tc.Tensor], mask : Optional[tc.Tensor] = None) :
+        """
+        Args:
+            index: record slice of a subject, or record indices of a batch sized [max records, subjects].
+                epss of them are returned by forward.
+            mask: (optional) mask of the real records of a batch, epss of the others are zero.
+        """
+        value = _index_values(self.parameter_values, self.scratch_values, index)
+        if mask is not None :
+            value = tc.where(mask, value, tc.zeros_like(value))
+        self.value = value.requires_grad_()
 
     def forward(self):
-        return self.parameter_values[str(self.id)]
+        return self.value
 
 class CovarianceMatrix(nn.Module) :
     def __init__(self,
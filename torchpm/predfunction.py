@@ -1,6 +1,8 @@
 from abc import abstractmethod
 
-from typing import Any, Dict, Iterable, Set
+import math
+
+from typing import Any, Dict, Iterable, Set, Tuple
 
 import torch as tc
 
@@ -8,9 +10,17 @@ import torch.nn as nn
 
 from torchdiffeq import odeint
 
+from torch.utils.checkpoint import checkpoint
+
 
 from collections import ChainMap
 
+from contextlib import contextmanager
+
+from collections.abc import Mapping
+
+from functools import reduce
+
 
 from torchpm import data
 
@@ -22,8 +32,21 @@ from .misc import *
 
 class PredictionFunction(tc.nn.Module):
 
+    """
+
+    Args:
+
+        per_record_eps: a prediction of a record depends on the eps of the same record only.
+            if it is true, the jacobian of the predictions by each eps is computed as its diagonal only,
+            a model whose prediction depends on the eps of other records gets wrong h with it.
+            it is false by default, and a model can set it to true as a class attribute.
+
+    """
+
     ESSENTIAL_COLUMNS : List[str] = ['ID', 'TIME', 'AMT', 'RATE', 'DV', 'MDV', 'CMT']
 
+    per_record_eps : bool = False
+
     def __init__(self,
 
                 dataset : data.CSVDataset,
@@ -35,13 +58,20 @@ class PredictionFunction(tc.nn.Module):
         self._column_names = dataset.column_names
         self._output_column_names = output_column_names
         self._ids = set()
+        self._subject_indice : Dict[str, int] = {}
         self._record_lengths : Dict[str, int] = {}
+        self._record_offsets : List[int] = []
+        self._total_record_length = 0
         self._max_record_length = 0
+        self._scratch_state : Optional[Tuple] = None
 
         for data in tc.utils.data.DataLoader(dataset, batch_size=None, shuffle=False, num_workers=0):  # type: ignore
             id = data[0][:, self._column_names.index('ID')][0]
             self._ids.add(int(id))
+            self._subject_indice[str(int(id))] = len(self._subject_indice)
             self._record_lengths[str(int(id))] = data[0].size()[0]
+            self._record_offsets.append(self._total_record_length)
+            self._total_record_length += data[0].size()[0]
             self._max_record_length = max(data[0].size()[0], self._max_record_length)
         
         self._set_estimated_parameters()
@@ -66,16 +96,124 @@ class PredictionFunction(tc.nn.Module):
                 elif att_type is Eta :
                     self._eta_names.add(att_name)
 
-                    for id in self._ids :
-                        eta_value = tc.tensor(0.1, device=self.dataset.device) 
-                        att.parameter_values.update({str(int(id)): tc.nn.Parameter(eta_value)}) # type: ignore
+                    eta_value = tc.full((len(self._subject_indice),), 0.1, device=self.dataset.device)
+                    att.parameter_values = tc.nn.Parameter(eta_value)
 
                 elif att_type is Eps :
                     self._eps_names.add(att_name)
 
-                    for id in self._ids :
-                        eps_value = tc.zeros(self._record_lengths[str(int(id))], requires_grad=True, device=self.dataset.device)
-                        att.parameter_values[str(int(id))] = eps_value
+                    att.parameter_values = tc.zeros(self._total_record_length, device=self.dataset.device)
+
+
+    def _get_subject_index(self, id : str, record_length : int) -> int:
+
+        """
+
+        subject index of id, a subject which is not in the dataset or has other record length is added
+        as a scratch subject, it must be in scratch_subjects context. (e.g. simulation)
+
+        """
+
+        if id in self._subject_indice and self._record_lengths[id] == record_length :
+
+            return self._subject_indice[id]
+
+
+        if self._scratch_state is None :
+
+            raise Exception('subject ' + id + ' is not in the dataset, it must be added in scratch_subjects context.')
+
+
+        with tc.no_grad() :
+
+            if id not in self._subject_indice :
+
+                self._ids.add(int(id))
+
+                self._subject_indice[id] = len(self._subject_indice)
+
+                self._record_offsets.append(0)
+
+                for name in self._eta_names :
+
+                    att = getattr(self, name)
+
+                    eta_value = tc.full((1,), 0.1, device=att.parameter_values.device)
+
+                    att.scratch_values = tc.cat([att.scratch_values, eta_value])
+
+
+            index = self._subject_indice[id]
+
+            self._record_lengths[id] = record_length
+
+            self._record_offsets[index] = self._total_record_length
+
+            self._total_record_length += record_length
+
+            self._max_record_length = max(record_length, self._max_record_length)
+
+
+            for name in self._eps_names :
+
+                att = getattr(self, name)
+
+                eps_value = tc.zeros(record_length, device=att.parameter_values.device)
+
+                att.scratch_values = tc.cat([att.scratch_values, eps_value])
+
+
+        return index
+
+
+    @contextmanager
+    def scratch_subjects(self) :
+
+        """
+
+        context of the subjects added by _get_subject_index.
+        their etas and epss are kept in scratch_values of Eta and Eps, and they are discarded with the subjects at the end,
+        so the parameters and state_dict of the model are not changed.
+
+        """
+
+        if self._scratch_state is not None :
+
+            yield
+
+            return
+
+
+        self._scratch_state = (set(self._ids), dict(self._subject_indice), dict(self._record_lengths), list(self._record_offsets),
+                                self._total_record_length, self._max_record_length)
+
+        for name in [*self._eta_names, *self._eps_names] :
+
+            att = getattr(self, name)
+
+            att.scratch_values = tc.zeros(0, device=att.parameter_values.device)
+
+        try :
+
+            yield
+
+        finally :
+
+            self._ids, self._subject_indice, self._record_lengths, self._record_offsets, \
+                self._total_record_length, self._max_record_length = self._scratch_state
+
+            self._scratch_state = None
+
+            for name in [*self._eta_names, *self._eps_names] :
+
+                getattr(self, name).scratch_values = None
+
+
+    def _get_record_slice(self, id : str) -> slice:
+
+        offset = self._record_offsets[self._subject_indice[id]]
+
+        return slice(offset, offset + self._record_lengths[id])
 
 
     def _get_estimated_parameters(self, names) :
@@ -144,12 +282,12 @@ class PredictionFunction(tc.nn.Module):
         return self._get_estimated_parameter_values(self._theta_names)
     
 
-    def get_eta_parameter_values(self) -> Dict[str, nn.ParameterDict]:  # type: ignore
+    def get_eta_parameter_values(self) -> Dict[str, nn.Parameter]:  # type: ignore
 
         return self._get_estimated_parameter_values(self._eta_names)
     
 
-    def get_eps_parameter_values(self) -> Dict[str, Dict[str, nn.Parameter]]:  # type: ignore
+    def get_eps_parameter_values(self) -> Dict[str, tc.Tensor]:  # type: ignore
 
         return self._get_estimated_parameter_values(self._eps_names)
 
@@ -170,11 +308,7 @@ class PredictionFunction(tc.nn.Module):
 
                     # self._eps_names.add(att_name.replace('eps_', ''))
 
-                    for id in self._ids :
-
-                        eps_value = tc.zeros(self._record_lengths[str(int(id))], requires_grad=True, device=self.dataset.device)
-
-                        att.parameter_values[str(int(id))] = eps_value
+                    att.parameter_values.zero_()
         
 
     def _get_amt_indice(self, dataset) :
@@ -183,7 +317,7 @@ class PredictionFunction(tc.nn.Module):
 
         end = amts.size()[0]
 
-        start_index = tc.squeeze(amts.nonzero(), 0)
+        start_index = amts.nonzero()[:, 0]
         
 
         if start_index.size()[0] == 0 :
@@ -225,16 +359,18 @@ class PredictionFunction(tc.nn.Module):
         self._id = id
         
 
+        index = self._subject_indice[id]
+
         for name in self._eta_names:
 
-            att = getattr(self, name)
-            att.id = id
+            getattr(self, name).set_index(index)
 
 
+        record_slice = self._get_record_slice(id)
+
         for name in self._eps_names:
 
-            att = getattr(self, name)
-            att.id = id
+            getattr(self, name).set_index(record_slice)
         
 
         input_columns = self._get_input_columns(dataset)
@@ -250,6 +386,110 @@ class PredictionFunction(tc.nn.Module):
         return parameters
     
 
+    def _pre_forward_batch(self, dataset):
+
+        """
+
+        Args:
+
+            dataset: padded records of subjects sized [subjects, max records, columns]
+
+        Returns:
+
+            parameters: columns and parameters sized [max records, subjects]
+
+            record_mask: mask of the real records sized [max records, subjects]
+
+        """
+
+        ids = [str(int(id)) for id in dataset[:, 0, self._column_names.index('ID')]]
+
+        subject_size, max_record_length = dataset.size()[0], dataset.size()[1]
+
+
+        indice = [self._subject_indice[id] for id in ids]
+
+        record_lengths = tc.tensor([self._record_lengths[id] for id in ids], device = dataset.device)
+
+        record_offsets = tc.tensor([self._record_offsets[index] for index in indice], device = dataset.device)
+
+        record_index = tc.arange(max_record_length, device = dataset.device).unsqueeze(1)
+
+        record_mask = record_index < record_lengths
+
+
+        for name in self._eta_names:
+
+            getattr(self, name).set_index(tc.tensor(indice, device = dataset.device))
+
+
+        eps_index = record_offsets + record_index.minimum(record_lengths - 1)
+
+        for name in self._eps_names:
+
+            getattr(self, name).set_index(eps_index, record_mask)
+
+
+        columns = dataset.permute(2, 1, 0)
+
+        parameters = {name: columns[i] for i, name in enumerate(self._column_names)}
+
+        self._calculate_parameters(parameters)
+
+        for key, para in parameters.items():
+
+            parameters[key] = para.broadcast_to((max_record_length, subject_size))
+
+        return parameters, record_mask
+    
+
+    def _get_amt_indice_batch(self, dataset, record_mask) :
+
+        """
+
+        dose start indices of subjects by the same rule of _get_amt_indice
+
+        Args:
+
+            dataset: padded records of subjects sized [subjects, max records, columns]
+
+            record_mask: mask of the real records sized [max records, subjects]
+
+        Returns:
+
+            start_indice: record indices of doses sized [max doses, subjects]
+
+            dose_mask: mask of the real doses sized [max doses, subjects]
+
+        """
+
+        amts = dataset[:, :, self._column_names.index('AMT')].t()
+
+        subject_size = amts.size()[1]
+
+        record_index = tc.arange(amts.size()[0], device = dataset.device).unsqueeze(1)
+
+        is_start = ((amts != 0) | (record_index == 0)) \
+                    & (record_index < record_mask.sum(0) - 1) \
+                    & (amts != 0).any(0)
+
+        dose_size = int(is_start.sum(0).max())
+
+        start_indice = tc.zeros(dose_size, subject_size, dtype=tc.int64, device = dataset.device)
+
+        dose_mask = tc.zeros(dose_size, subject_size, dtype=tc.bool, device = dataset.device)
+
+        start_record_index, start_subject_index = is_start.nonzero(as_tuple=True)
+
+        dose_index = is_start.cumsum(0)[start_record_index, start_subject_index] - 1
+
+        start_indice[dose_index, start_subject_index] = start_record_index
+
+        dose_mask[dose_index, start_subject_index] = True
+
+        return start_indice, dose_mask
+    
+
     def _post_forward(self, dataset, parameters):
 
         record_length = dataset.size()[0]
@@ -269,6 +509,19 @@ class PredictionFunction(tc.nn.Module):
                 output_columns[cov_name] = parameters[cov_name]
 
         return {'etas': self.get_etas(), 'epss': self.get_epss(), 'output_columns': output_columns}
+    
+
+    def _post_forward_batch(self, dataset, parameters):
+
+        record_shape = (dataset.size()[1], dataset.size()[0])
+
+        output_columns = {}
+
+        for cov_name in self._output_column_names :
+
+            output_columns[cov_name] = parameters[cov_name].broadcast_to(record_shape).t()
+
+        return {'etas': self.get_etas(), 'epss': self.get_epss(), 'output_columns': output_columns}
 
     @abstractmethod
     def _set_estimated_parameters(self):
@@ -289,6 +542,27 @@ class PredictionFunction(tc.nn.Module):
         pass
 
 
+    def forward_batch(self, dataset):
+
+        """
+
+        batched forward of subjects
+
+        Args:
+
+            dataset: padded records of subjects sized [subjects, max records, columns]
+
+        Returns:
+
+            y_pred, mdv_mask and output_columns sized [subjects, max records], etas and epss.
+            in _calculate_parameters, _calculate_preds and _calculate_error, columns are sized [max records, subjects],
+            etas are sized [subjects] and epss are sized [max records, subjects].
+
+        """
+
+        raise NotImplementedError(type(self).__name__ + ' does not support batched forward.')
+
+
     def _get_input_columns(self, dataset) :
         dataset = dataset.t()
         
@@ -306,6 +580,18 @@ class PredictionFunction(tc.nn.Module):
 
 class PredictionFunctionByTime(PredictionFunction):
 
+    """
+
+    Args:
+
+        vectorized_superposition: calculate the predictions of all doses by one _calculate_preds call and sum them.
+            columns of the records from each dose are given to _calculate_preds as [records, doses],
+            or [max records, doses * subjects] in batched forward.
+
+    """
+
+    vectorized_superposition : bool = False
+
     def __init__(self, dataset: data.CSVDataset, output_column_names: List[str]):
         super().__init__(dataset, output_column_names)
 
@@ -314,200 +600,1344 @@ class PredictionFunctionByTime(PredictionFunction):
         pass
 
 
-    def forward(self, dataset) :
+    def _calculate_superposition(self, parameters, start_indice, dose_mask) :
 
-        parameters = self._pre_forward(dataset)
+        """
 
+        Args:
 
-        f = tc.zeros(dataset.size()[0], device = dataset.device)
+            parameters: columns and parameters sized [records, subjects]
 
-        amt_indice = self._get_amt_indice(dataset)
+            start_indice: record indices of doses sized [doses, subjects]
 
-        for i in range(len(amt_indice) - 1):
+            dose_mask: mask of the real doses sized [doses, subjects]
 
-            start_time_index = amt_indice[i]
- 
+        Returns:
 
-            #누적하기 위해 앞부분 생성
+            sum of the predictions by the doses sized [records, subjects]
 
-            dataset_pre = dataset[:start_time_index, :]
+        """
 
-            f_pre = tc.zeros(dataset_pre.size()[0], device = dataset.device)
+        record_length, subject_size = parameters['TIME'].size()
 
+        dose_size = start_indice.size()[0]
 
-            times = parameters['TIME'][start_time_index:]
-            start_time = times[0]
+        if dose_size == 0 :
 
-            amts = parameters['AMT'][start_time_index].repeat(parameters['AMT'][start_time_index:].size()[0])
+            return tc.zeros_like(parameters['TIME'])
 
-            parameters_sliced = {k: v[start_time_index:] for k, v in parameters.items()}
-            
-            parameters_sliced['TIME'] = times
 
-            parameters_sliced['AMT'] = amts
+        record_index = tc.arange(record_length, device = start_indice.device).view(-1, 1, 1)
 
-            t = times - start_time
+        subject_index = tc.arange(subject_size, device = start_indice.device)
 
-            f_cur = self._calculate_preds(t, parameters_sliced)
 
-            f = f + tc.cat([f_pre, f_cur], 0)
-        
+        #각 투약 시점부터 당겨온 기록, [records, doses, subjects]
 
-        y_pred = self._calculate_error(f, parameters)
+        sliced_index = (record_index + start_indice).clamp(max = record_length - 1)
 
-        mdv_mask = dataset[:,self._column_names.index('MDV')] == 0
-        
+        parameters_sliced = {k: v[sliced_index, subject_index].reshape(record_length, -1) for k, v in parameters.items()}
 
-        post_forward_output = self._post_forward(dataset, parameters)
-        
 
-        return ChainMap({'y_pred': y_pred, 'mdv_mask': mdv_mask}, post_forward_output)
+        times = parameters_sliced['TIME']
 
+        parameters_sliced['AMT'] = parameters_sliced['AMT'][:1].expand_as(times)
 
-class PredictionFunctionByODE(PredictionFunction):
+        t = times - times[0]
 
-    """
+        f = self._calculate_preds(t, parameters_sliced).reshape(record_length, dose_size, subject_size)
 
-    ordinary equation solver
 
-    Args:
+        #원래 기록 위치로 되돌림
 
-        rtol: ratio tolerance about ordinary differential equation integration
+        f = f.gather(0, (record_index - start_indice).clamp(min = 0))
 
-        atol: absolute tolerance about ordinary differential equation integration
+        f = tc.where((record_index >= start_indice) & dose_mask, f, tc.zeros_like(f))
 
-    """
+        return f.sum(1)
 
-    rtol : float = 1e-2
 
-    atol : float = 1e-2
+    def forward(self, dataset) :
 
-    def __init__(self, dataset: data.CSVDataset, output_column_names: List[str]):
-        super().__init__(dataset, output_column_names)
-        self.parameter_values : Dict[str, tc.Tensor] = {}
+        parameters = self._pre_forward(dataset)
 
 
-    @abstractmethod
+        f = tc.zeros(dataset.size()[0], device = dataset.device)
 
-    def _calculate_preds(self, t : tc.Tensor, y: tc.Tensor , parameters : Dict[str, tc.Tensor]) -> tc.Tensor:
-        pass
- 
+        amt_indice = self._get_amt_indice(dataset)
 
-    def ode_function(self, t, y):
+        if self.vectorized_superposition :
 
-        index = (self.t < t).sum() -1
+            start_indice = amt_indice[:-1].unsqueeze(1)
 
-        parameters_sliced = {k: v[index] for k, v in self.parameter_values.items()}
-    
+            parameters_unsqueezed = {k: v.unsqueeze(1) for k, v in parameters.items()}
 
-        return self._calculate_preds(t, y, parameters_sliced) + \
-            self.infusion_rate * (self.infusion_end_time > t)
-    
+            f = self._calculate_superposition(parameters_unsqueezed, start_indice, tc.ones_like(start_indice, dtype=tc.bool))[:, 0]
 
-    def forward(self, dataset) :
+        else :
 
-        parameters = self._pre_forward(dataset)
-        self.parameter_values = parameters
+            for i in range(len(amt_indice) - 1):
 
+                start_time_index = amt_indice[i]
+    
 
-        self.max_cmt = int(dataset[:,self._column_names.index('CMT')].max())
-        
+                #누적하기 위해 앞부분 생성
 
-        y_pred_arr = []
+                dataset_pre = dataset[:start_time_index, :]
 
-        parameters_result = {}
+                f_pre = tc.zeros(dataset_pre.size()[0], device = dataset.device)
 
-        y_init = tc.zeros(self.max_cmt+1, device = dataset.device)
 
-        self.infusion_rate = tc.zeros(self.max_cmt+1, device = dataset.device)
+                times = parameters['TIME'][start_time_index:]
+                start_time = times[0]
 
-        self.infusion_end_time = tc.zeros(self.max_cmt+1, device = dataset.device)
+                amts = parameters['AMT'][start_time_index].repeat(parameters['AMT'][start_time_index:].size()[0])
 
-        amt_indice = self._get_amt_indice(dataset)
+                parameters_sliced = {k: v[start_time_index:] for k, v in parameters.items()}
+                
+                parameters_sliced['TIME'] = times
 
-        for i in range(len(amt_indice) - 1):
+                parameters_sliced['AMT'] = amts
 
-            amt_slice = slice(amt_indice[i], amt_indice[i+1]+1)
+                t = times - start_time
 
+                f_cur = self._calculate_preds(t, parameters_sliced)
 
-            amt = parameters['AMT'][amt_indice[i]]
+                f = f + tc.cat([f_pre, f_cur], 0)
+        
 
-            rate = parameters['RATE'][amt_indice[i]]
+        y_pred = self._calculate_error(f, parameters)
 
-            cmt  = parameters['CMT'][amt_slice]
+        mdv_mask = dataset[:,self._column_names.index('MDV')] == 0
+        
 
-            times = parameters['TIME'][amt_slice]
+        post_forward_output = self._post_forward(dataset, parameters)
+        
 
+        return ChainMap({'y_pred': y_pred, 'mdv_mask': mdv_mask}, post_forward_output)
 
-            if  rate == 0 :                    
 
-                bolus = tc.zeros(self.max_cmt + 1, device = dataset.device)
-                
+    def forward_batch(self, dataset) :
 
-                bolus[cmt[0].to(tc.int64)] = amt
+        parameters, record_mask = self._pre_forward_batch(dataset)
 
-                y_init = y_init + bolus
+        start_indice, dose_mask = self._get_amt_indice_batch(dataset, record_mask)
 
-            else :
+        if self.vectorized_superposition :
 
-                time = times[0]
- 
+            f = self._calculate_superposition(parameters, start_indice, dose_mask)
 
-                mask = tc.ones(self.max_cmt +1, device = dataset.device)
+        else :
 
-                mask[cmt[0].to(tc.int64)] = 0
- 
+            f = tc.zeros_like(parameters['TIME'])
 
-                rate_vector = tc.zeros(self.max_cmt +1, device = dataset.device)
+            for i in range(start_indice.size()[0]):
 
-                rate_vector[cmt[0]] = rate
+                f = f + self._calculate_superposition(parameters, start_indice[i:i+1], dose_mask[i:i+1])
+        
 
-                self.infusion_rate = self.infusion_rate * mask + rate_vector
- 
+        y_pred = self._calculate_error(f, parameters)
 
-                infusion_end_time_vector = tc.zeros(self.max_cmt +1, device = dataset.device)
+        mdv_mask = (dataset[:, :, self._column_names.index('MDV')].t() == 0) & record_mask
 
-                infusion_end_time_vector[cmt[0]] = time + amt / rate
 
-                self.infusion_end_time = self.infusion_end_time * mask + infusion_end_time_vector
-                
-            self.t = times
+        post_forward_output = self._post_forward_batch(dataset, parameters)
+        
 
-            result = odeint(self.ode_function, y_init, self.t, rtol=self.rtol, atol=self.atol)
+        return ChainMap({'y_pred': y_pred.t(), 'mdv_mask': mdv_mask.t()}, post_forward_output)
 
-            y_integrated = result
 
-            y_init = result[-1]
-            
+class PiecewiseConstantParameters(Mapping):
 
-            cmt_mask = tc.nn.functional.one_hot(cmt.to(tc.int64)).to(dataset.device)  # type: ignore
+    """
 
-            y_integrated = y_integrated.masked_select(cmt_mask==1)  # type: ignore
+    parameters of records, piecewise constant over the times of the records for an ode function.
+    values are stacked once, and at(t) looks up the records of t by searchsorted without building a dict.
 
+    Args:
+
+        parameters: parameters sized [records] or [records, subjects]
+
+        times: record times sized like parameters, sorted along records
+
+    """
+
+    def __init__(self, parameters : Dict[str, tc.Tensor], times : tc.Tensor):
+
+        self._names = {name: i for i, name in enumerate(parameters.keys())}
+
+        dtype = reduce(tc.promote_types, [value.dtype for value in parameters.values()], times.dtype)
+
+        self._values = tc.stack([value.broadcast_to(times.size()).to(dtype) for value in parameters.values()])
+
+        # searchsorted은 마지막 차원에서 찾으므로 subject를 앞으로 둔다
+        self._breakpoints = times.t().contiguous()
+
+        self._current = self._values[:, 0]
+    
+
+    def at(self, t : tc.Tensor) -> 'PiecewiseConstantParameters':
+
+        """
+
+        set the parameters of the last record before t, or the first record
+
+        Args:
+
+            t: time
+
+        Returns:
+
+            self
+
+        """
+
+        index = (tc.searchsorted(self._breakpoints, t.detach().reshape(1).expand(*self._breakpoints.size()[:-1], 1).contiguous()) - 1).clamp(min = 0)
+
+        if self._values.dim() == 2 :
+
+            self._current = self._values[:, index[0]]
+
+        else :
+
+            self._current = self._values.gather(1, index.t().unsqueeze(0).expand(self._values.size()[0], 1, -1)).squeeze(1)
+
+        return self
+    
+
+    def __getitem__(self, name : str) -> tc.Tensor:
+
+        return self._current[self._names[name]]
+    
+
+    def __iter__(self):
+
+        return iter(self._names)
+    
+
+    def __len__(self):
+
+        return len(self._names)
+
+
+# Dormand-Prince 5(4) tableau, the last stage is the derivative at the end of the step (first same as last)
+_DOPRI5_C = (1/5, 3/10, 4/5, 8/9, 1.)
+
+_DOPRI5_A = ((1/5,),
+             (3/40, 9/40),
+             (44/45, -56/15, 32/9),
+             (19372/6561, -25360/2187, 64448/6561, -212/729),
+             (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656))
+
+_DOPRI5_B = (35/384, 0., 500/1113, 125/192, -2187/6784, 11/84)
+
+_DOPRI5_E = (71/57600, 0., -71/16695, 71/1920, -17253/339200, 22/525, -1/40)
+
+
+class PredictionFunctionByODE(PredictionFunction):
+
+    """
+
+    ordinary equation solver
+
+    Args:
+
+        rtol: ratio tolerance about ordinary differential equation integration
+
+        atol: absolute tolerance about ordinary differential equation integration
+
+        linear: the model is linear, dy/dt = rate_matrix @ y + input by _calculate_rate_matrix.
+            the states are advanced exactly by matrix exponentials between records instead of integration.
+
+        checkpoint_integration: the solver steps of each integration are not kept for backward but integrated again.
+            memory does not grow with the number of solver steps, at the cost of integrating twice.
+            g of FOCEInter by the jacobian with create_graph keeps the steps integrated again in its graph,
+            so the memory of fitting is bounded with forward_sensitivity only, which gives g without the jacobian.
+
+        forward_sensitivity: the sensitivities of the states to the etas are integrated with the states by forward sensitivity equations,
+            and the sensitivities of the predictions are returned as y_pred_sensitivities for g of FOCEInter.
+            etas must enter the model through _calculate_parameters, and the doses are taken as independent of the etas.
+            it is ignored by a linear model.
+
+        event_integration: a subject is integrated once over all of its records by an adaptive driver,
+            doses and infusion ends are applied as events, and the step size is kept across them.
+            the amounts of the records are written to one buffer instead of concatenating dose segments.
+
+        solver: method of the steps of event_integration, 'dopri5' or 'rosenbrock'.
+            'rosenbrock' is an L-stable linearly implicit method for stiff models with the jacobian by _calculate_jacobian,
+            and it integrates by event_integration in forward and forward_batch.
+
+        max_steps: maximum number of accepted and rejected steps of event_integration between two events.
+            the integration raises an exception beyond it, on a non-finite error or on step size underflow.
+
+    """
+
+    rtol : float = 1e-2
+
+    atol : float = 1e-2
+
+    linear : bool = False
+
+    checkpoint_integration : bool = False
+
+    forward_sensitivity : bool = False
+
+    event_integration : bool = False
+
+    solver : str = 'dopri5'
+
+    max_steps : int = 100000
+
+    def __init__(self, dataset: data.CSVDataset, output_column_names: List[str]):
+        super().__init__(dataset, output_column_names)
+        self.parameter_values : Dict[str, tc.Tensor] = {}
+        self.parameter_context : PiecewiseConstantParameters
+        self.sensitivity_contexts : Optional[List[PiecewiseConstantParameters]] = None
+        self._check_integration_options()
+
+
+    def _check_integration_options(self) :
+
+        """
+
+        raises on the options of integration which can not be used together
+
+        """
+
+        if self.solver not in ('dopri5', 'rosenbrock') :
+
+            raise Exception('solver must be dopri5 or rosenbrock, not ' + self.solver)
+
+        if self.linear :
+
+            return
+
+        if self.forward_sensitivity and self.solver != 'dopri5' :
+
+            raise Exception('forward_sensitivity is integrated by odeint, it can not be used with solver ' + self.solver)
+
+        if self.checkpoint_integration and (self.event_integration or self.solver != 'dopri5') :
+
+            raise Exception('checkpoint_integration is for odeint, it can not be used with event_integration or solver ' + self.solver)
+
+
+    @abstractmethod
+
+    def _calculate_preds(self, t : tc.Tensor, y: tc.Tensor , parameters : Dict[str, tc.Tensor]) -> tc.Tensor:
+        pass
+    
+
+    def _calculate_rate_matrix(self, parameters : Dict[str, tc.Tensor]) -> Tuple[tc.Tensor, tc.Tensor]:
+
+        """
+
+        rate matrix and input of a linear model
+
+        Args:
+
+            parameters: parameters sized [records, subjects], subjects is 1 in forward
+
+        Returns:
+
+            rate_matrix: sized [compartments, compartments, records, subjects]
+
+            input: sized [compartments, records, subjects]
+
+        """
+
+        raise NotImplementedError(type(self).__name__ + ' is not a linear model.')
+    
+
+    def _calculate_jacobian(self, t : tc.Tensor, y : tc.Tensor, parameters : Mapping) -> tc.Tensor:
+
+        """
+
+        jacobian of _calculate_preds by y for the rosenbrock solver, by autograd unless a model overrides it
+
+        Args:
+
+            t: time
+
+            y: states sized [compartments]
+
+            parameters: parameters at t
+
+        Returns:
+
+            jacobian sized [compartments, compartments]
+
+        """
+
+        create_graph = tc.is_grad_enabled()
+
+        with tc.enable_grad() :
+
+            if not y.requires_grad :
+
+                y = y.detach().requires_grad_()
+
+            return jacobian(self._calculate_preds(t, y, parameters), [y], create_graph = create_graph)[0]
+ 
+
+    def ode_function(self, t, y):
+
+        if self.sensitivity_contexts is not None :
+
+            return self._sensitivity_function(t, y)
+
+        return self._calculate_preds(t, y, self.parameter_context.at(t)) + \
+            self.infusion_rate * (self.infusion_end_time > t)
+    
+
+    def _sensitivity_function(self, t, y) :
+
+        """
+
+        ode function of the states augmented with their sensitivities to the etas
+
+        Args:
+
+            t: time
+
+            y: states and their sensitivities sized [1 + etas, compartments, subjects]
+
+        Returns:
+
+            derivatives of y
+
+        """
+
+        parameter_context = self.parameter_context.at(t)
+
+        parameters = {name: parameter_context[name] for name in parameter_context}
+
+        sensitivity_contexts = [context.at(t) for context in self.sensitivity_contexts]  # type: ignore
+
+        parameter_sensitivities = {name: tc.stack([context[name] for context in sensitivity_contexts]) for name in sensitivity_contexts[0]}
+
+        preds, sensitivities = self._propagate_sensitivities(lambda y, p: self._calculate_preds(t, y, p),
+                                                             y[0], parameters, y[1:], parameter_sensitivities)
+
+        preds = preds + self.infusion_rate * (self.infusion_end_time > t)
+
+        return tc.cat([preds.unsqueeze(0), sensitivities])
+    
+
+    def _propagate_sensitivities(self, function, y, parameters, y_sensitivities, parameter_sensitivities) :
+
+        """
+
+        value of function and its sensitivities to the etas by jacobian-vector products
+
+        Args:
+
+            function: function of y and parameters
+
+            y: states
+
+            parameters: parameters of function
+
+            y_sensitivities: sensitivities of y sized [etas, *y size]
+
+            parameter_sensitivities: sensitivities of the parameters depending on the etas sized [etas, *parameter size]
+
+        Returns:
+
+            value: function(y, parameters)
+
+            sensitivities: sized [etas, *value size]
+
+        """
+
+        if not y.requires_grad :
+
+            y = y.detach().requires_grad_()
+
+        value = function(y, parameters)
+
+        names = list(parameter_sensitivities.keys())
+
+        sensitivities = jvp(value,
+                            [y] + [parameters[name] for name in names],
+                            [y_sensitivities] + [parameter_sensitivities[name] for name in names])
+
+        return value, sensitivities
+    
+
+    def _calculate_parameter_sensitivities(self, parameters) :
+
+        """
+
+        sensitivities of the parameters to the etas by one batched backward pass
+
+        Args:
+
+            parameters: parameters sized [records] or [records, subjects]
+
+        Returns:
+
+            eta_names: names of the etas in the order of the sensitivities
+
+            parameter_sensitivities: sensitivities of the parameters depending on the etas sized [etas, *parameter size]
+
+        """
+
+        eta_names = sorted(self._eta_names)
+
+        etas = [getattr(self, name)() for name in eta_names]
+
+        names = [name for name, value in parameters.items() if value.requires_grad]
+
+        if len(names) == 0 :
+
+            raise Exception('no parameter depends on the etas for forward_sensitivity.')
+
+        values = tc.stack([parameters[name] for name in names])
+
+        # subject끼리는 독립이므로 subject 방향으로 더해서 미분
+        jacobians = jacobian(values.reshape(values.size()[0] * values.size()[1], -1).sum(-1), etas)
+
+        sensitivities = tc.stack([jac.reshape(values.size()) for jac in jacobians])
+
+        return eta_names, {name: sensitivities[:, i] for i, name in enumerate(names)}
+    
+
+    def _odeint(self, y, times, options = None) :
+
+        """
+
+        integrate ode_function from y over times
+
+        Args:
+
+            y: initial states
+
+            times: times of outputs, the first one is of y
+
+            options: options of the odeint solver
+
+        Returns:
+
+            states at times
+
+        """
+
+        if not self.checkpoint_integration :
+
+            return odeint(self.ode_function, y, times, rtol=self.rtol, atol=self.atol, options=options)
+        
+
+        # backward에서 다시 적분할 때 쓰도록 이 구간의 상태를 잡아둔다
+        parameter_context, sensitivity_contexts = self.parameter_context, self.sensitivity_contexts
+
+        infusion_rate, infusion_end_time = self.infusion_rate, self.infusion_end_time
+
+        def integrate(y) :
+
+            self.parameter_context, self.sensitivity_contexts = parameter_context, sensitivity_contexts
+
+            self.infusion_rate, self.infusion_end_time = infusion_rate, infusion_end_time
+
+            return odeint(self.ode_function, y, times, rtol=self.rtol, atol=self.atol, options=options)
+
+        return checkpoint(integrate, y, use_reentrant=False)
+    
+
+    def forward(self, dataset) :
+
+        self._check_integration_options()
+
+        parameters = self._pre_forward(dataset)
+        self.parameter_values = parameters
+
+        if self.linear :
+
+            cmts = dataset[:, self._column_names.index('CMT')].to(tc.int64).unsqueeze(1)
+
+            is_dose = (dataset[:, self._column_names.index('AMT')] != 0).unsqueeze(1)
+
+            y_integrated = self._integrate_linear({k: v.unsqueeze(1) for k, v in parameters.items()}, cmts, is_dose).squeeze(1)
+
+            y_pred = self._calculate_error(y_integrated, parameters)
+
+            mdv_mask = dataset[:,self._column_names.index('MDV')] == 0
+
+            return ChainMap({'y_pred': y_pred, 'mdv_mask': mdv_mask}, self._post_forward(dataset, parameters))
+
+        if self.forward_sensitivity and len(self._eta_names) > 0 and tc.is_grad_enabled() :
+
+            return self._forward_sensitivity(dataset, parameters)
+
+        if self.event_integration or self.solver != 'dopri5' :
+
+            cmts = dataset[:, self._column_names.index('CMT')].to(tc.int64)
+
+            is_dose = dataset[:, self._column_names.index('AMT')] != 0
+
+            y_pred = self._calculate_error(self._integrate_events(parameters, cmts, is_dose), parameters)
+
+            mdv_mask = dataset[:,self._column_names.index('MDV')] == 0
+
+            return ChainMap({'y_pred': y_pred, 'mdv_mask': mdv_mask}, self._post_forward(dataset, parameters))
+
+        self.parameter_context = PiecewiseConstantParameters(parameters, parameters['TIME'])
+
+        self.sensitivity_contexts = None
+
+
+        self.max_cmt = int(dataset[:,self._column_names.index('CMT')].max())
+        
+
+        y_pred_arr = []
+
+        parameters_result = {}
+
+        y_init = tc.zeros(self.max_cmt+1, device = dataset.device)
+
+        self.infusion_rate = tc.zeros(self.max_cmt+1, device = dataset.device)
+
+        self.infusion_end_time = tc.zeros(self.max_cmt+1, device = dataset.device)
+
+        amt_indice = self._get_amt_indice(dataset)
+
+        for i in range(len(amt_indice) - 1):
+
+            amt_slice = slice(amt_indice[i], amt_indice[i+1]+1)
+
+
+            amt = parameters['AMT'][amt_indice[i]]
+
+            rate = parameters['RATE'][amt_indice[i]]
+
+            cmt  = parameters['CMT'][amt_slice]
+
+            times = parameters['TIME'][amt_slice]
+
+
+            if  rate == 0 :                    
+
+                bolus = tc.zeros(self.max_cmt + 1, device = dataset.device)
+                
+
+                bolus[cmt[0].to(tc.int64)] = amt
+
+                y_init = y_init + bolus
+
+            else :
+
+                time = times[0]
+ 
+
+                mask = tc.ones(self.max_cmt +1, device = dataset.device)
+
+                mask[cmt[0].to(tc.int64)] = 0
+ 
+
+                rate_vector = tc.zeros(self.max_cmt +1, device = dataset.device)
+
+                rate_vector[cmt[0]] = rate
+
+                self.infusion_rate = self.infusion_rate * mask + rate_vector
+ 
+
+                infusion_end_time_vector = tc.zeros(self.max_cmt +1, device = dataset.device)
+
+                infusion_end_time_vector[cmt[0]] = time + amt / rate
+
+                self.infusion_end_time = self.infusion_end_time * mask + infusion_end_time_vector
+                
+            self.t = times
+
+            result = self._odeint(y_init, self.t)
+
+            y_integrated = result
+
+            y_init = result[-1]
+            
+
+            cmt_mask = tc.nn.functional.one_hot(cmt.to(tc.int64)).to(dataset.device)  # type: ignore
+
+            y_integrated = y_integrated.masked_select(cmt_mask==1)  # type: ignore
+
+
+            parameters_sliced = {k: v[amt_slice] for k, v in self.parameter_values.items()}
+
+            y_pred = self._calculate_error(y_integrated, parameters_sliced)
+            
+
+            for k, v in parameters_sliced.items() :
+
+                if k not in parameters_result.keys() :
+
+                    parameters_result[k] = v
+
+                else :
+
+                    parameters_result[k] = tc.cat([parameters_result[k], parameters_sliced[k]])
+
+            y_pred_arr.append(y_pred)
+
+
+        mdv_mask = dataset[:,self._column_names.index('MDV')] == 0
+
+
+        post_forward_output = self._post_forward(dataset, parameters_result)
+        
+
+        return ChainMap({'y_pred': tc.cat(y_pred_arr), 'mdv_mask': mdv_mask}, post_forward_output)
+    
+
+    def _integrate_events(self, parameters, cmts, is_dose) :
+
+        """
+
+        amounts of a subject by one integration over all records, doses are events between the steps.
+
+        Args:
+
+            parameters: parameters sized [records]
+
+            cmts: compartments of records sized [records]
+
+            is_dose: mask of the dose records sized [records]
+
+        Returns:
+
+            amounts of the compartments of records sized [records]
+
+        """
+
+        times = parameters['TIME']
+
+        amts = parameters['AMT']
+
+        rates = parameters['RATE']
+
+        self.parameter_context = PiecewiseConstantParameters(parameters, times)
+
+        self.sensitivity_contexts = None
+
+        self.max_cmt = int(cmts.max())
+
+        device = times.device
+
+        dtype = times.dtype
+
+
+        y = tc.zeros(self.max_cmt + 1, device = device, dtype = dtype)
+
+        self.infusion_rate = tc.zeros(self.max_cmt + 1, device = device, dtype = dtype)
+
+        self.infusion_end_time = tc.zeros(self.max_cmt + 1, device = device, dtype = dtype)
+
+        amounts = tc.zeros(times.size()[0], device = device, dtype = dtype)
+
+        t = float(times[0])
+
+        dt = None
+
+        for i, time in enumerate(times.tolist()) :
+
+            # infusion이 끝나는 시간에 ode function이 불연속이므로 거기서 멈춘다
+            stops = sorted(end for end in self.infusion_end_time.tolist() if t < end < time) + [time]
+
+            for stop in stops :
+
+                if stop > t :
+
+                    y, dt = self._advance(t, stop, y, dt)
+
+                    t = stop
+
+            if is_dose[i] :
+
+                cmt_mask = tc.nn.functional.one_hot(cmts[i], self.max_cmt + 1) == 1
+
+                if rates[i] == 0 :
+
+                    y = y + cmt_mask * amts[i]
+
+                else :
+
+                    self.infusion_rate = tc.where(cmt_mask, rates[i], self.infusion_rate)
+
+                    self.infusion_end_time = tc.where(cmt_mask, times[i] + amts[i] / rates[i], self.infusion_end_time)
+
+            amounts[i] = y[cmts[i]]
+
+        return amounts
+    
+
+    def _advance(self, t_start, t_end, y, dt) :
+
+        """
+
+        advance the states by adaptive steps of solver, the ode function is smooth between t_start and t_end.
+
+        Args:
+
+            t_start: start time
+
+            t_end: end time
+
+            y: states at t_start
+
+            dt: step size proposed by the last step, or None for the first one
+
+        Returns:
+
+            y: states at t_end
+
+            dt: step size proposed for the next step
+
+        """
+
+        k_first = self.ode_function(tc.tensor(t_start, device = y.device, dtype = y.dtype), y)
+
+        if dt is None :
+
+            dt = self._initial_step(y, k_first)
+
+        t = t_start
+
+        step_function, order = {'dopri5': (self._dopri5_step, 5), 'rosenbrock': (self._rosenbrock_step, 2)}[self.solver]
+
+        for _ in range(self.max_steps) :
+
+            if t >= t_end :
+
+                return y, dt
+
+            step = min(dt, t_end - t)
+
+            if step < tc.finfo(y.dtype).eps * max(abs(t), 1.) :
+
+                raise Exception('step size underflow of ' + self.solver + ' at t = ' + str(t))
+
+            y_next, error, k_last = step_function(t, y, step, k_first)
 
-            parameters_sliced = {k: v[amt_slice] for k, v in self.parameter_values.items()}
+            scale = self.atol + self.rtol * tc.maximum(y.detach().abs(), y_next.detach().abs())
 
-            y_pred = self._calculate_error(y_integrated, parameters_sliced)
-            
+            error_ratio = float((error.detach() / scale).pow(2).mean().sqrt())
 
-            for k, v in parameters_sliced.items() :
+            if not math.isfinite(error_ratio) :
 
-                if k not in parameters_result.keys() :
+                raise Exception('non-finite error of ' + self.solver + ' step at t = ' + str(t))
 
-                    parameters_result[k] = v
+            factor = 10. if error_ratio == 0 else min(10., max(0.2, 0.9 * error_ratio ** (-1 / order)))
 
-                else :
+            if error_ratio <= 1 :
 
-                    parameters_result[k] = tc.cat([parameters_result[k], parameters_sliced[k]])
+                # 멈출 시간에 맞추려고 줄인 step은 다음 step을 줄이지 않는다
+                dt = max(dt, step * factor) if step < dt else step * factor
 
-            y_pred_arr.append(y_pred)
+                t = t_end if step == t_end - t else t + step
+
+                y = y_next
+
+                k_first = k_last if k_last is not None else self.ode_function(tc.tensor(t, device = y.device, dtype = y.dtype), y)
+
+            else :
+
+                dt = step * factor
+
+        if t < t_end :
+
+            raise Exception(self.solver + ' did not reach t = ' + str(t_end) + ' in ' + str(self.max_steps) + ' steps')
+
+        return y, dt
+    
+
+    def _dopri5_step(self, t, y, dt, k_first) :
+
+        """
+
+        Args:
+
+            t: time
+
+            y: states at t
+
+            dt: step size
+
+            k_first: derivative at t
+
+        Returns:
+
+            y_next: states at t + dt
+
+            error: local error estimate of y_next
+
+            k_last: derivative at t + dt
+
+        """
+
+        ks = [k_first]
+
+        for c, a in zip(_DOPRI5_C, _DOPRI5_A) :
+
+            y_stage = y + dt * sum(a_j * k for a_j, k in zip(a, ks))
+
+            ks.append(self.ode_function(tc.tensor(t + c * dt, device = y.device), y_stage))
+
+        y_next = y + dt * sum(b * k for b, k in zip(_DOPRI5_B, ks))
+
+        ks.append(self.ode_function(tc.tensor(t + dt, device = y.device), y_next))
+
+        error = dt * sum(e * k for e, k in zip(_DOPRI5_E, ks))
+
+        return y_next, error, ks[-1]
+    
+
+    def _rosenbrock_step(self, t, y, dt, k_first) :
+
+        """
+
+        L-stable two stage Rosenbrock step (ROS2) with the embedded first order solution
+
+        Args:
+
+            t: time
+
+            y: states at t
+
+            dt: step size
+
+            k_first: derivative at t
+
+        Returns:
+
+            y_next: states at t + dt
+
+            error: local error estimate of y_next
+
+            k_last: None, the derivative at t + dt is not computed
+
+        """
+
+        gamma = 1 + 1 / 2 ** 0.5
+
+        t_tensor = tc.tensor(t, device = y.device)
+
+        jac = self._calculate_jacobian(t_tensor, y, self.parameter_context.at(t_tensor))
+
+        w = tc.eye(y.size()[0], device = y.device) - gamma * dt * jac
+
+        k_1 = tc.linalg.solve(w, k_first.unsqueeze(-1)).squeeze(-1)
+
+        k_2 = tc.linalg.solve(w, (self.ode_function(tc.tensor(t + dt, device = y.device), y + dt * k_1) - 2 * k_1).unsqueeze(-1)).squeeze(-1)
+
+        y_next = y + dt * (1.5 * k_1 + 0.5 * k_2)
+
+        error = dt * 0.5 * (k_1 + k_2)
+
+        return y_next, error, None
+    
+
+    def _initial_step(self, y, dy) :
+
+        """
 
+        first step size from the scales of the states and their derivatives
+
+        """
+
+        scale = self.atol + self.rtol * y.detach().abs()
+
+        y_norm = float((y.detach() / scale).pow(2).mean().sqrt())
+
+        dy_norm = float((dy.detach() / scale).pow(2).mean().sqrt())
+
+        if y_norm < 1e-5 or dy_norm < 1e-5 :
+
+            return 1e-6
+
+        return 0.01 * y_norm / dy_norm
+    
+
+    def _forward_sensitivity(self, dataset, parameters) :
+
+        """
+
+        forward of a subject by the batched integration of one subject with the forward sensitivity equations
+
+        """
+
+        eta_names, parameter_sensitivities = self._calculate_parameter_sensitivities(parameters)
+
+        cmts = dataset[:, self._column_names.index('CMT')].to(tc.int64).unsqueeze(1)
+
+        is_dose = (dataset[:, self._column_names.index('AMT')] != 0).unsqueeze(1)
+
+        y_integrated, y_integrated_sensitivities = self._integrate_batch({k: v.unsqueeze(1) for k, v in parameters.items()},
+                                                                         tc.ones_like(is_dose), cmts, is_dose,
+                                                                         {k: v.unsqueeze(-1) for k, v in parameter_sensitivities.items()})
+
+        y_pred, y_pred_sensitivities = self._propagate_sensitivities(self._calculate_error,
+                                                                     y_integrated.squeeze(1), parameters,
+                                                                     y_integrated_sensitivities.squeeze(-1), parameter_sensitivities)
 
         mdv_mask = dataset[:,self._column_names.index('MDV')] == 0
 
+        return ChainMap({'y_pred': y_pred,
+                         'y_pred_sensitivities': dict(zip(eta_names, y_pred_sensitivities)),
+                         'mdv_mask': mdv_mask},
+                        self._post_forward(dataset, parameters))
 
-        post_forward_output = self._post_forward(dataset, parameters_result)
+
+
+    def forward_batch(self, dataset) :
+
+        """
+
+        in _calculate_preds, y is sized [compartments, subjects] and parameters are sized [subjects].
+        all subjects are integrated together on the union of their record times,
+        doses are applied as jumps of the states of the subjects at their times.
+        with forward_sensitivity, y_pred_sensitivities are sized [subjects, max records] for each eta.
+
+        """
+
+        self._check_integration_options()
+
+        parameters, record_mask = self._pre_forward_batch(dataset)
+
+        self.parameter_values = parameters
+
+        cmts = dataset[:, :, self._column_names.index('CMT')].t().to(tc.int64)
+
+        is_dose = (dataset[:, :, self._column_names.index('AMT')].t() != 0) & record_mask
+
+        y_integrated_sensitivities = None
+
+        if self.linear :
+
+            y_integrated = self._integrate_linear(parameters, cmts, is_dose)
+
+        elif self.forward_sensitivity and len(self._eta_names) > 0 and tc.is_grad_enabled() :
+
+            eta_names, parameter_sensitivities = self._calculate_parameter_sensitivities(parameters)
+
+            y_integrated, y_integrated_sensitivities = self._integrate_batch(parameters, record_mask, cmts, is_dose, parameter_sensitivities)
+
+        elif self.event_integration or self.solver != 'dopri5' :
+
+            record_lengths = record_mask.sum(0).tolist()
+
+            y_integrated = tc.zeros_like(parameters['TIME'])
+
+            for i, length in enumerate(record_lengths) :
+
+                y_integrated[:length, i] = self._integrate_events({k: v[:length, i] for k, v in parameters.items()}, cmts[:length, i], is_dose[:length, i])
+
+        else :
+
+            y_integrated = self._integrate_batch(parameters, record_mask, cmts, is_dose)
+
+        mdv_mask = (dataset[:, :, self._column_names.index('MDV')].t() == 0) & record_mask
+
+
+        post_forward_output = self._post_forward_batch(dataset, parameters)
+
+        if y_integrated_sensitivities is not None :
+
+            y_pred, y_pred_sensitivities = self._propagate_sensitivities(self._calculate_error,
+                                                                         y_integrated, parameters,
+                                                                         y_integrated_sensitivities, parameter_sensitivities)
+
+            return ChainMap({'y_pred': y_pred.t(),
+                             'y_pred_sensitivities': {name: sensitivity.t() for name, sensitivity in zip(eta_names, y_pred_sensitivities)},
+                             'mdv_mask': mdv_mask.t()},
+                            post_forward_output)
+
+        y_pred = self._calculate_error(y_integrated, parameters)
         
 
-        return ChainMap({'y_pred': tc.cat(y_pred_arr), 'mdv_mask': mdv_mask}, post_forward_output)
+        return ChainMap({'y_pred': y_pred.t(), 'mdv_mask': mdv_mask.t()}, post_forward_output)
+
+
+    def _integrate_batch(self, parameters, record_mask, cmts, is_dose, parameter_sensitivities = None) :
+
+        """
+
+        Args:
+
+            parameters: parameters sized [max records, subjects]
+
+            record_mask: mask of the real records sized [max records, subjects]
+
+            cmts: compartments of records sized [max records, subjects]
+
+            is_dose: mask of the dose records sized [max records, subjects]
+
+            parameter_sensitivities: (optional) sensitivities of the parameters depending on the etas sized [etas, max records, subjects].
+                if it is given, the sensitivities of the states are integrated together.
+
+        Returns:
+
+            amounts of the compartments of records sized [max records, subjects],
+            and their sensitivities sized [etas, max records, subjects] if parameter_sensitivities is given
+
+        """
+
+        self.parameter_context = PiecewiseConstantParameters(parameters, parameters['TIME'])
+
+        self.sensitivity_contexts = None
+
+        if parameter_sensitivities is not None :
+
+            eta_size = len(self._eta_names)
+
+            self.sensitivity_contexts = [PiecewiseConstantParameters({name: sensitivity[i] for name, sensitivity in parameter_sensitivities.items()}, parameters['TIME'])
+                                            for i in range(eta_size)]
+
+        subject_size = record_mask.size()[1]
+
+        device = record_mask.device
+
+        subject_index = tc.arange(subject_size, device = device)
+
+        record_index = tc.arange(record_mask.size()[0], device = device).unsqueeze(1)
+
+
+        self.max_cmt = int(cmts.max())
+
+        times = parameters['TIME']
+
+        is_infusion = is_dose & (parameters['RATE'] != 0)
+        
+
+        grid = times[record_mask].unique()
+
+        dose_times = times[is_dose].unique()
+
+        event_times = tc.cat([grid[:1], dose_times, grid[-1:]]).unique()
+
+
+        y = tc.zeros(self.max_cmt + 1, subject_size, device = device)
+
+        self.infusion_rate = tc.zeros(self.max_cmt + 1, subject_size, device = device)
+
+        self.infusion_end_time = tc.zeros(self.max_cmt + 1, subject_size, device = device)
+
+        # grid의 각 시간에서 dose 적용 전과 후의 state
+        pre_states = [y.unsqueeze(0)]
+
+        post_states = []
+
+        if self.sensitivity_contexts is not None :
+
+            sensitivities = tc.zeros(eta_size, *y.size(), device = device)
+
+            pre_sensitivities = [sensitivities.unsqueeze(0)]
+
+            post_sensitivities = []
+
+        for i, event_time in enumerate(event_times) :
+
+            dose_record_index, dose_subject_index = (is_dose & (times == event_time)).nonzero(as_tuple=True)
+
+            dose_cmt = cmts[dose_record_index, dose_subject_index]
+
+            amt = parameters['AMT'][dose_record_index, dose_subject_index]
+            
+
+            bolus = tc.where(is_infusion[dose_record_index, dose_subject_index], tc.zeros_like(amt), amt)
+
+            y = y.index_put((dose_cmt, dose_subject_index), bolus, accumulate = True)
+
+            infusion_mask = tc.zeros_like(y, dtype = tc.bool).index_put((dose_cmt, dose_subject_index), is_infusion[dose_record_index, dose_subject_index])
+
+            rate = tc.where(is_infusion, parameters['RATE'], tc.ones_like(parameters['RATE']))[dose_record_index, dose_subject_index]
+
+            infusion_end_time = tc.zeros_like(y).index_put((dose_cmt, dose_subject_index), event_time + amt / rate)
+
+            rate = tc.zeros_like(y).index_put((dose_cmt, dose_subject_index), rate)
+
+            self.infusion_rate = tc.where(infusion_mask, rate, self.infusion_rate)
+
+            self.infusion_end_time = tc.where(infusion_mask, infusion_end_time, self.infusion_end_time)
+
+            if i == len(event_times) - 1 :
+
+                post_states.append(y.unsqueeze(0))
+
+                if self.sensitivity_contexts is not None :
+
+                    post_sensitivities.append(sensitivities.unsqueeze(0))
+
+                break
+
+
+            times_segment = grid[(grid >= event_time) & (grid <= event_times[i+1])]
+
+            # 같은 용법의 subject들은 주입 종료 시간이 같으므로 중복을 없앤다
+            jump_times = tc.unique(self.infusion_end_time[(self.infusion_end_time > event_time) & (self.infusion_end_time < event_times[i+1])])
+
+            if self.sensitivity_contexts is not None :
+
+                result = self._odeint(tc.cat([y.unsqueeze(0), sensitivities]), times_segment, {'jump_t': jump_times.detach()})
+
+                result, sensitivity_result = result[:, 0], result[:, 1:]
+
+                sensitivities = sensitivity_result[-1]
+
+                pre_sensitivities.append(sensitivity_result[1:])
+
+                post_sensitivities.append(sensitivity_result[:-1])
+
+            else :
+
+                result = self._odeint(y, times_segment, {'jump_t': jump_times.detach()})
+
+            y = result[-1]
+
+            pre_states.append(result[1:])
+
+            post_states.append(result[:-1])
+        
+
+        pre_states = tc.cat(pre_states)
+
+        post_states = tc.cat(post_states)
+
+
+        # 같은 시간의 dose record가 앞에 있으면 dose가 적용된 state를 쓴다
+        last_dose_index = tc.where(is_dose, record_index, -1).cummax(0).values
+
+        is_post_dose = (last_dose_index >= 0) & (times.gather(0, last_dose_index.clamp(min = 0)) == times)
+
+        grid_index = tc.searchsorted(grid, times.t().contiguous()).t()
+
+        amounts = tc.where(is_post_dose,
+                        post_states[grid_index, cmts, subject_index],
+                        pre_states[grid_index, cmts, subject_index])
+
+        if self.sensitivity_contexts is None :
+
+            return amounts
+        
+
+        pre_sensitivities = tc.cat(pre_sensitivities)
+
+        post_sensitivities = tc.cat(post_sensitivities)
+
+        amount_sensitivities = tc.where(is_post_dose.unsqueeze(-1),
+                                        post_sensitivities[grid_index, :, cmts, subject_index],
+                                        pre_sensitivities[grid_index, :, cmts, subject_index])
+
+        return amounts, amount_sensitivities.permute(2, 0, 1)
+
+
+    def _integrate_linear(self, parameters, cmts, is_dose) :
+
+        """
+
+        amounts of a linear model by matrix exponentials of the intervals between records.
+        infusions are exact by splitting the intervals at the infusion end times.
+
+        Args:
+
+            parameters: parameters sized [records, subjects]
+
+            cmts: compartments of records sized [records, subjects]
+
+            is_dose: mask of the dose records sized [records, subjects]
+
+        Returns:
+
+            amounts of the compartments of records sized [records, subjects]
+
+        """
+
+        rate_matrix, input = self._calculate_rate_matrix(parameters)
+
+        times = parameters['TIME']
+
+        record_length, subject_size = times.size()
+
+        cmt_size = rate_matrix.size()[0]
+
+        rate_matrix = rate_matrix.broadcast_to(cmt_size, cmt_size, record_length, subject_size).permute(2, 3, 0, 1)
+
+        input = input.broadcast_to(cmt_size, record_length, subject_size).permute(1, 2, 0)
+
+
+        amts = parameters['AMT']
+
+        rates = parameters['RATE']
+
+        is_infusion = is_dose & (rates != 0)
+
+        cmt_one_hot = tc.nn.functional.one_hot(cmts, cmt_size).to(times.dtype)
+
+        bolus = (amts * (is_dose & ~is_infusion)).unsqueeze(-1) * cmt_one_hot
+
+        intervals = (times[1:] - times[:-1]).unsqueeze(-1)
+
+
+        if is_infusion.any() :
+
+            # record마다 compartment별로 마지막 infusion record를 찾는다
+            record_index = tc.arange(record_length, device = times.device)[:, None, None]
+
+            infusion_index = tc.where(is_infusion.unsqueeze(-1) & (cmt_one_hot == 1), record_index, -1).cummax(0).values
+
+            is_infused = infusion_index >= 0
+
+            infusion_index = infusion_index.clamp(min = 0)
+
+            infusion_end_times = times + amts / tc.where(is_infusion, rates, tc.ones_like(rates))
+
+            infusion_rates = tc.where(is_infused,
+                                rates.unsqueeze(-1).expand(-1, -1, cmt_size).gather(0, infusion_index),
+                                tc.zeros_like(cmt_one_hot))
+
+            infusion_end_times = tc.where(is_infused,
+                                infusion_end_times.unsqueeze(-1).expand(-1, -1, cmt_size).gather(0, infusion_index),
+                                times.unsqueeze(-1).expand(-1, -1, cmt_size))
+
+            infusion_ends = (infusion_end_times[:-1] - times[:-1].unsqueeze(-1)).clamp(min = 0).minimum(intervals)
+
+            bounds = tc.cat([tc.zeros_like(intervals), infusion_ends.sort(-1).values, intervals], -1)
+
+            sub_intervals = bounds.diff(dim = -1)
+
+            is_infusing = infusion_ends.unsqueeze(-2) >= bounds[:, :, 1:].unsqueeze(-1)
+
+            inputs = input[:-1].unsqueeze(-2) + infusion_rates[:-1].unsqueeze(-2) * is_infusing
+
+        else :
+
+            sub_intervals = intervals
+
+            inputs = input[:-1].unsqueeze(-2)
+        
+
+        # [[A, u], [0, 0]]의 matrix exponential에 A의 exponential과 u의 적분이 같이 들어있다
+        sub_interval_size = sub_intervals.size()[-1]
+
+        augmented_matrix = tc.cat([rate_matrix[:-1].unsqueeze(2).expand(-1, -1, sub_interval_size, -1, -1), inputs.unsqueeze(-1)], -1)
+
+        augmented_matrix = tc.cat([augmented_matrix, tc.zeros_like(augmented_matrix[..., :1, :])], -2)
+
+        transitions = tc.linalg.matrix_exp(augmented_matrix * sub_intervals[..., None, None])
+
+        transition = transitions[:, :, 0]
+
+        for i in range(1, sub_interval_size) :
+
+            transition = transitions[:, :, i] @ transition
+        
+
+        y = bolus[0]
+
+        amounts = [y]
+
+        for i in range(record_length - 1) :
+
+            y = (transition[i, :, :cmt_size, :cmt_size] @ y.unsqueeze(-1)).squeeze(-1) \
+                + transition[i, :, :cmt_size, cmt_size] + bolus[i+1]
+
+            amounts.append(y)
 
+        return tc.stack(amounts).gather(-1, cmts.unsqueeze(-1)).squeeze(-1)